@@ -3,19 +3,15 @@
 # Find the average travel time from the given
 #  centers to every point in Ithaca.
 
-import itertools as it
-import osmnx as ox
-import networkx as nx
-import geopandas as gpd
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
-import matplotlib.lines as mlines
-from shapely.geometry import Point, LineString, Polygon
-from descartes import PolygonPatch
+
+import instrument
+from graphstore import load_graph, graph_path, to_networkx
+from snapping import load_index, snap_points
+from routing import graph_matrix, nearest_times
+from traveltimes import meters_per_minute, summarize_times
 
 ################# Initial Setup #################
-ox.config(log_console=True, use_cache=True)
 
 # Configure the place, network type, trip times, and travel speed.
 place = 'Ithaca, NY, USA'
@@ -25,49 +21,121 @@ network_type = 'drive'
 trip_times = np.linspace(3,30,num=27) # In minutes.
 travel_speed = 10 # In mph.
 
-################ Graph Processing ###############
-
-# Download the street network.
-G = ox.graph_from_place(place, network_type=network_type)
-
-# Find nearest locations on graph to centers 
-# defined above.
-center_nodes = [0] * len(centers)
-for i in range(0, len(centers)): 
-    center_nodes[i] = ox.get_nearest_node(G, centers[i])
-
-G = ox.project_graph(G)
-
-# Miles per hour to meter per minute.
-meters_per_minute = (travel_speed * 5280 * 12 * 2.54) / (100 * 60)
-
-# Add an edge attribute for time in minutes required to 
-# traverse each edge.
-for u, v, k, data in G.edges(data=True, keys=True):
-    data['time'] = data['length'] / meters_per_minute
-
-################## Find Average #################
-sub_graphs = [None] * len(trip_times)
-
-# For every trip time, get the total coverage for that 
-# trip time amongst all centers.
-for i in range(0, len(trip_times)):
-    sub_graphs[i] = nx.Graph()
-
-    # Get all nodes from one time from all centers.
-    for center_node in center_nodes:
-        sub_graphs[i].add_nodes_from(nx.ego_graph(G, center_node, 
-            radius=trip_times[i], distance='time'))
-
-    # Remove nodes that have been counted previously.
-    for j in range(i-1, -1, -1):
-        sub_graphs[i].remove_nodes_from(sub_graphs[j])
-
-# Compute the weighted average to find the average 
-# time of travel.
-average = 0
-for sub, time in zip(sub_graphs, trip_times):
-    average += sub.number_of_nodes() * time
-average /= G.number_of_nodes()
-
-print('Average = ' + str(average))
\ No newline at end of file
+# Directory of the graph store.
+cache_dir = 'graph_cache'
+
+# Either 'exact', which finds the travel time to every node
+# in one pass, or 'bands', which rounds each node up to the
+# edge of the first trip time band that reaches it.
+method = 'exact'
+percentiles = [50, 90, 95]
+
+################ Helper Functions ###############
+# Find the average travel time from the nearest of the
+# centers to every node, given a graphstore.StreetGraph,
+# its routing matrix of edge times and the positions of
+# the centers. The 'exact' method also returns the
+# percentiles, the number of nodes first reached in each
+# band of trip_times and the number of unreachable nodes.
+# Returns a dict of the results.
+def average_times(sg, matrix, center_nodes, trip_times,
+        percentiles=(50, 90, 95), method='exact', travel_speed=10):
+    if method == 'exact':
+        # Find the time from the nearest center to every node
+        # in a single multi-source pass.
+        times = nearest_times(matrix, center_nodes)
+        average, histogram, pcts, unreached = summarize_times(
+            times, trip_times, percentiles)
+
+        return {'average': float(average),
+            'percentiles': dict(zip(percentiles, pcts.tolist())),
+            'histogram': histogram.tolist(),
+            'unreachable': int(unreached)}
+
+    elif method == 'bands':
+        return {'average': band_average(sg, center_nodes, trip_times,
+            travel_speed)}
+
+    else:
+        raise ValueError('Unknown method: ' + str(method))
+
+# Reference method rounding each node up to the edge of the
+# first trip time band that reaches it, with networkx.
+def band_average(sg, center_nodes, trip_times, travel_speed):
+    import networkx as nx
+
+    # Rebuild the networkx graph for this reference method.
+    G = to_networkx(sg, meters_per_minute(travel_speed))
+    center_nodes = [int(sg.node_ids[i]) for i in center_nodes]
+    sub_graphs = [None] * len(trip_times)
+
+    # For every trip time, get the total coverage for that
+    # trip time amongst all centers.
+    for i in range(0, len(trip_times)):
+        sub_graphs[i] = nx.Graph()
+
+        # Get all nodes from one time from all centers.
+        for center_node in center_nodes:
+            instrument.count('ego_graph_calls')
+            with instrument.stage('ego_graph'):
+                sub_graphs[i].add_nodes_from(nx.ego_graph(G,
+                    center_node, radius=trip_times[i], distance='time'))
+
+        # Remove nodes that have been counted previously.
+        for j in range(i-1, -1, -1):
+            sub_graphs[i].remove_nodes_from(sub_graphs[j])
+
+    # Compute the weighted average to find the average
+    # time of travel.
+    average = 0
+    for sub, time in zip(sub_graphs, trip_times):
+        average += sub.number_of_nodes() * time
+    average /= G.number_of_nodes()
+
+    return average
+
+# Output the results of average_times.
+def print_average(result, trip_times):
+    print('Average = ' + str(result['average']))
+    if 'histogram' not in result:
+        return
+
+    for p, pct in result['percentiles'].items():
+        print(str(p) + 'th percentile = ' + str(pct))
+
+    # Output the number of nodes first reached in each band.
+    lower = 0
+    for count, time in zip(result['histogram'], sorted(trip_times)):
+        print('(' + str(lower) + ', ' + str(time) + '] min: ' +
+            str(count))
+        lower = time
+    print('> ' + str(lower) + ' min: ' + str(result['histogram'][-1]))
+    print('Unreachable = ' + str(result['unreachable']))
+
+
+def main():
+    ############### Graph Processing ##############
+
+    # Load the projected street network from the graph store,
+    # downloading and projecting it only on the first run.
+    sg = load_graph(place, network_type, cache_dir=cache_dir)
+
+    # Snap the centers defined above to the positions of
+    # their nearest nodes on the graph, warning about any
+    # that are far from the network.
+    tree = load_index(sg, graph_path(place, network_type,
+        cache_dir=cache_dir))
+    center_nodes = snap_points(tree, centers)[0].tolist()
+
+    # Build the routing matrix of the time in minutes
+    # required to traverse each edge.
+    matrix = graph_matrix(sg, meters_per_minute(travel_speed))
+
+    ################# Find Average ################
+    result = average_times(sg, matrix, center_nodes, trip_times,
+        percentiles, method, travel_speed)
+    print_average(result, trip_times)
+
+
+if __name__ == "__main__":
+    main()
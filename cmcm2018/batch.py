@@ -0,0 +1,307 @@
+################### CMCM 2018 ###################
+# Run many average, optimize and isochrone scenarios
+# from a file. Scenarios sharing a street network and
+# travel speed are grouped so the graph is loaded and
+# weighted once per group, groups run concurrently in
+# worker processes, and each result is written as a
+# line of JSON as soon as it completes.
+#   python batch.py scenarios.jsonl --out results.jsonl
+# The file holds one JSON scenario per line (or a JSON
+# list of them), for example
+#   {"name": "depots", "kind": "optimize",
+#    "centers": [[42.46089, -76.50496], ...],
+#    "num_centers": 3, "trip_time": 6, "travel_speed": 10}
+# with 'kind' one of 'average', 'optimize' or
+# 'isochrone'. 'place', 'network_type' and
+# 'travel_speed' default to Ithaca, 'drive' and 10 mph,
+# and the remaining fields are the arguments of
+# average.average_times, optimize.optimize_centers or
+# polygons.make_iso_polys, defaulting to the settings of
+# the average and optimize scripts. Isochrone scenarios
+# may set 'mode' to 'raster' to use raster.raster_iso_polys.
+
+import sys
+import json
+import time
+import argparse
+import traceback
+import multiprocessing as mp
+from queue import Empty
+from collections import OrderedDict
+
+from graphstore import load_graph, graph_path
+from snapping import load_index, snap_points
+from routing import graph_matrix
+from traveltimes import meters_per_minute
+import average
+import optimize
+from average import average_times
+from optimize import optimize_centers
+
+DEFAULTS = {'place': 'Ithaca, NY, USA', 'network_type': 'drive',
+    'travel_speed': 10}
+
+KINDS = ['average', 'optimize', 'isochrone']
+
+# Queue the results of every worker process are sent on.
+worker_results = None
+
+################ Helper Functions ###############
+# Read scenarios from a JSON list or a file of JSON lines,
+# filling in the defaults and a name for each. Raises a
+# ValueError for a scenario of unknown kind.
+def read_scenarios(path):
+    with open(path) as f:
+        text = f.read()
+    if text.lstrip().startswith('['):
+        scenarios = json.loads(text)
+    else:
+        scenarios = [json.loads(line) for line in text.splitlines()
+            if line.strip()]
+
+    for i, scenario in enumerate(scenarios):
+        for key, value in DEFAULTS.items():
+            scenario.setdefault(key, value)
+        scenario.setdefault('name', str(i))
+        if scenario.get('kind') not in KINDS:
+            raise ValueError('Unknown kind in scenario ' +
+                scenario['name'] + ': ' + str(scenario.get('kind')))
+
+    return scenarios
+
+# Group scenarios by (place, network type, travel speed),
+# keeping the order in which groups first appear.
+def group_scenarios(scenarios):
+    groups = OrderedDict()
+    for scenario in scenarios:
+        key = (scenario['place'], scenario['network_type'],
+            scenario['travel_speed'])
+        groups.setdefault(key, []).append(scenario)
+    return groups
+
+# Run a single scenario on a graphstore.StreetGraph with
+# its KD-tree and routing matrix of edge times. Returns a
+# dict of the results.
+def run_scenario(sg, tree, matrix, scenario):
+    centers = scenario['centers']
+    center_nodes = snap_points(tree, centers)[0].tolist()
+    kind = scenario['kind']
+
+    if kind == 'average':
+        result = average_times(sg, matrix, center_nodes,
+            scenario.get('trip_times', average.trip_times),
+            scenario.get('percentiles', average.percentiles),
+            scenario.get('method', average.method),
+            scenario['travel_speed'])
+
+    elif kind == 'optimize':
+        result = optimize_centers(sg, matrix, center_nodes,
+            scenario['num_centers'],
+            scenario.get('trip_time', optimize.trip_time),
+            scenario.get('method', optimize.method),
+            scenario.get('solver', optimize.solver),
+            scenario.get('num_best', optimize.num_best),
+            travel_speed=scenario['travel_speed'])
+
+        num_nodes = len(sg.node_ids)
+        result['best'] = [{'centers': [centers[i] for i in indices],
+            'coverage': int(size) / num_nodes}
+            for size, indices in result['best']]
+        if 'bound' in result:
+            result['bound'] = result['bound'] / num_nodes
+
+    else:
+        # Geometry is only loaded for the scenarios that need it.
+        from polygons import make_iso_polys, iso_features
+        from raster import raster_iso_polys
+
+        trip_times = scenario.get('trip_times', [3, 4, 5, 6, 7, 8, 9, 10])
+        mode = scenario.get('mode', 'vector')
+        if mode == 'vector':
+            polys = make_iso_polys(sg, matrix, center_nodes, trip_times,
+                scenario.get('partial', True),
+                rings=scenario.get('rings', False))
+        elif mode == 'raster':
+            polys = raster_iso_polys(sg, matrix, center_nodes,
+                trip_times, rings=scenario.get('rings', False),
+                grid_file=scenario.get('grid_file'))
+        else:
+            raise ValueError('Unknown mode: ' + str(mode))
+        result = {'type': 'FeatureCollection', 'features': iso_features(
+            sg.crs, polys, trip_times, [{'center': center}
+            for center in centers])}
+
+    return result
+
+# Load the graph of a group once and run each of its
+# scenarios, sending every result on worker_results as it
+# completes, as a (group, position in group, result)
+# tuple. Failures are reported as results holding the error
+# rather than stopping the group.
+def run_group(group, key, scenarios, cache_dir='graph_cache'):
+    place, network_type, travel_speed = key
+    try:
+        sg = load_graph(place, network_type, cache_dir=cache_dir)
+        tree = load_index(sg, graph_path(place, network_type,
+            cache_dir=cache_dir))
+        matrix = graph_matrix(sg, meters_per_minute(travel_speed))
+    except Exception:
+        error = traceback.format_exc()
+        for i, scenario in enumerate(scenarios):
+            worker_results.put((group, i, {'name': scenario['name'],
+                'kind': scenario['kind'], 'error': error}))
+        return
+
+    for i, scenario in enumerate(scenarios):
+        start = time.perf_counter()
+        try:
+            result = run_scenario(sg, tree, matrix, scenario)
+        except Exception:
+            result = {'error': traceback.format_exc()}
+
+        result['name'] = scenario['name']
+        result['kind'] = scenario['kind']
+        result['seconds'] = time.perf_counter() - start
+        worker_results.put((group, i, result))
+
+def attach_results(queue):
+    global worker_results
+    worker_results = queue
+
+# Entry point of the worker process running a group.
+def run_worker(queue, group, key, scenarios, cache_dir='graph_cache'):
+    attach_results(queue)
+    run_group(group, key, scenarios, cache_dir)
+
+# Build the graph store and KD-tree of every graph in the
+# groups before any worker starts, so that groups sharing a
+# graph do not download it at the same time. Returns a dict
+# from (place, network type) to the error of every graph
+# that could not be built.
+def prepare_graphs(groups, cache_dir='graph_cache'):
+    errors = {}
+    for place, network_type in OrderedDict.fromkeys(
+            (key[0], key[1]) for key in groups):
+        try:
+            sg = load_graph(place, network_type, cache_dir=cache_dir)
+            load_index(sg, graph_path(place, network_type,
+                cache_dir=cache_dir))
+        except Exception:
+            errors[(place, network_type)] = traceback.format_exc()
+    return errors
+
+# Run every scenario, with up to processes groups at once,
+# and write each result to out as a line of JSON as soon as
+# it completes. Groups whose graph cannot be built are
+# written as errors without running. Each group runs in its
+# own worker process, so if one dies, for example when it
+# runs out of memory, only the scenarios of its group whose
+# results never arrived are written as errors. Returns the
+# number of failed scenarios.
+def run_batch(scenarios, out, processes=None, cache_dir='graph_cache'):
+    def write(result):
+        out.write(json.dumps(result) + '\n')
+        out.flush()
+        return 'error' in result
+
+    groups = group_scenarios(scenarios)
+    errors = prepare_graphs(groups, cache_dir)
+    failed = 0
+    for key, group in groups.items():
+        error = errors.get((key[0], key[1]))
+        if error is not None:
+            for scenario in group:
+                failed += write({'name': scenario['name'],
+                    'kind': scenario['kind'], 'error': error})
+    groups = [(key, group) for key, group in groups.items()
+        if (key[0], key[1]) not in errors]
+
+    # Positions of the scenarios of each group still to come.
+    pending = [set(range(len(group))) for _, group in groups]
+
+    # Results are sent through a manager process, so each one
+    # is queued before the worker sending it moves on, and a
+    # worker killed while sending one cannot corrupt the queue.
+    manager = mp.Manager()
+    results = manager.Queue()
+    processes = processes or mp.cpu_count()
+    running = {}
+    started = 0
+    with manager:
+        while any(pending):
+            for g, worker in list(running.items()):
+                if not worker.is_alive() and not pending[g]:
+                    del running[g]
+
+            while len(running) < processes and started < len(groups):
+                key, group = groups[started]
+                running[started] = mp.Process(target=run_worker,
+                    args=(results, started, key, group, cache_dir))
+                running[started].start()
+                started += 1
+
+            try:
+                g, i, result = results.get(timeout=1)
+            except Empty:
+                exited = [g for g, worker in running.items()
+                    if not worker.is_alive()]
+                if not exited:
+                    continue
+
+                # An exited worker may have sent its last results
+                # since the queue was found empty, so read them
+                # before failing the rest of its group.
+                while True:
+                    try:
+                        g, i, result = results.get_nowait()
+                    except Empty:
+                        break
+                    pending[g].discard(i)
+                    failed += write(result)
+
+                for g in exited:
+                    worker = running.pop(g)
+                    error = 'Worker process exited with code ' + \
+                        str(worker.exitcode)
+                    for i in sorted(pending[g]):
+                        scenario = groups[g][1][i]
+                        failed += write({'name': scenario['name'],
+                            'kind': scenario['kind'], 'error': error})
+                    pending[g].clear()
+                continue
+
+            pending[g].discard(i)
+            failed += write(result)
+
+        for worker in running.values():
+            worker.join()
+
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run a file of coverage scenarios.')
+    parser.add_argument('scenarios', help='JSON lines file of scenarios')
+    parser.add_argument('--out', help='write results to this JSON '
+        'lines file instead of stdout')
+    parser.add_argument('--processes', type=int, default=None,
+        help='number of groups to run at once (default: every core)')
+    parser.add_argument('--cache-dir', default='graph_cache')
+    args = parser.parse_args()
+
+    scenarios = read_scenarios(args.scenarios)
+    out = open(args.out, 'w') if args.out else sys.stdout
+    try:
+        failed = run_batch(scenarios, out, args.processes, args.cache_dir)
+    finally:
+        if args.out:
+            out.close()
+
+    if failed:
+        print(str(failed) + ' of ' + str(len(scenarios)) +
+            ' scenarios failed', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
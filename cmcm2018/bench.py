@@ -0,0 +1,323 @@
+################### CMCM 2018 ###################
+# Benchmark each stage of the ambulance coverage
+# pipeline on seeded synthetic street networks, so
+# performance can be measured offline and compared
+# between commits. Results are written as JSON:
+#   python bench.py --sizes 1000 10000 --out new.json
+#   python bench.py --out new.json --compare old.json
+# Import times of the headless entry points are checked
+# against a budget with
+#   python bench.py --imports
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+import scipy
+from scipy.spatial import cKDTree
+
+from graphstore import StreetGraph, csr_edges, save, load
+from routing import graph_matrix, nearest_times, shortest_times
+from snapping import load_index, snap_points
+from traveltimes import meters_per_minute
+from coverage import coverage_bits, top_combinations
+from polygons import make_iso_polys
+
+# Origin of the synthetic networks, near Ithaca.
+ORIGIN = (42.44, -76.50)
+
+# Spacing in meters between neighbouring grid nodes.
+SPACING = 100
+
+# Meters per degree of latitude.
+METERS_PER_DEGREE = 111320
+
+# Import time budget in seconds of each module run without
+# plotting, which must also not load any of HEAVY_MODULES.
+IMPORT_BUDGETS = {
+    'average': 1.0,
+    'optimize': 1.0,
+    'sweep': 1.5,
+    'batch': 1.0,
+}
+
+# Plotting and geometry packages, along with scipy.optimize,
+# which are only imported once a plot, polygon or integer
+# program is requested.
+HEAVY_MODULES = ['osmnx', 'matplotlib', 'descartes', 'geopandas',
+    'networkx', 'shapely', 'scipy.optimize']
+
+################ Helper Functions ###############
+# Build a StreetGraph from node coordinates in meters and
+# undirected edges (u, v) between node positions. Edges are
+# added in both directions with their straight-line length,
+# and nodes are placed around ORIGIN in an azimuthal
+# equidistant projection.
+def street_graph(x, y, u, v):
+    n = len(x)
+    length = np.hypot(x[u] - x[v], y[u] - y[v])
+    u, v, length = csr_edges(n, np.concatenate((u, v)),
+        np.concatenate((v, u)), np.concatenate((length, length)))
+
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(u, minlength=n), out=indptr[1:])
+
+    lat = ORIGIN[0] + y / METERS_PER_DEGREE
+    lon = ORIGIN[1] + x / (METERS_PER_DEGREE * np.cos(np.radians(lat)))
+    crs = '+proj=aeqd +lat_0={} +lon_0={} +units=m'.format(*ORIGIN)
+    return StreetGraph(np.arange(n, dtype=np.int64), lat, lon, x, y,
+        indptr, v.astype(np.int32), length, crs)
+
+# A square grid of about n nodes, with every node joined to
+# its four neighbours.
+def grid_graph(n, rng):
+    side = int(np.ceil(np.sqrt(n)))
+    ids = np.arange(side * side).reshape(side, side)
+    x, y = np.meshgrid(np.arange(side) * float(SPACING),
+        np.arange(side) * float(SPACING))
+
+    u = np.concatenate((ids[:, :-1].ravel(), ids[:-1, :].ravel()))
+    v = np.concatenate((ids[:, 1:].ravel(), ids[1:, :].ravel()))
+    return street_graph(x.ravel(), y.ravel(), u, v)
+
+# A grid with jittered nodes and a tenth of its streets
+# removed at random.
+def perturbed_graph(n, rng):
+    sg = grid_graph(n, rng)
+    x = sg.x + rng.uniform(-0.3, 0.3, len(sg.x)) * SPACING
+    y = sg.y + rng.uniform(-0.3, 0.3, len(sg.y)) * SPACING
+
+    u = np.repeat(np.arange(len(x)), np.diff(sg.indptr))
+    v = sg.indices.astype(np.int64)
+    keep = (u < v) & (rng.random(len(u)) >= 0.1)
+    return street_graph(x, y, u[keep], v[keep])
+
+# A random geometric graph of n nodes spread with the grid's
+# density, joining all nodes within the distance that gives
+# an average of four neighbours.
+def geometric_graph(n, rng):
+    side = np.sqrt(n) * SPACING
+    x, y = rng.uniform(0, side, n), rng.uniform(0, side, n)
+    radius = SPACING * np.sqrt(4 / np.pi)
+
+    pairs = cKDTree(np.column_stack((x, y))).query_pairs(radius,
+        output_type='ndarray')
+    return street_graph(x, y, pairs[:, 0], pairs[:, 1])
+
+GENERATORS = {
+    'grid': grid_graph,
+    'perturbed': perturbed_graph,
+    'geometric': geometric_graph,
+}
+
+# Run func repeat times and return the best wall time in
+# seconds along with the result of the last run.
+def best_time(func, repeat):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+# Project the nodes' latitude and longitude to the graph's
+# crs with pyproj, which osmnx uses for project_graph.
+def project(sg):
+    import pyproj
+
+    transformer = pyproj.Transformer.from_crs('EPSG:4326', sg.crs,
+        always_xy=True)
+    return transformer.transform(np.asarray(sg.lon), np.asarray(sg.lat))
+
+# Time every stage of the pipeline on one synthetic graph.
+# Returns a map of stage name -> best time in seconds.
+def bench_graph(sg, rng, repeat=3, num_candidates=20, num_centers=4,
+        trip_times=(3, 4, 5, 6), travel_speed=10, max_iso_nodes=200000):
+    stages = {}
+    n = len(sg.x)
+
+    # Saving and memory-mapped loading through the graph store.
+    path = tempfile.mkdtemp()
+    try:
+        stages['save'], _ = best_time(lambda: save(sg, path), repeat)
+        stages['load'], sg = best_time(lambda: load(path), repeat)
+        stages['snap_index'], tree = best_time(
+            lambda: load_index(sg), repeat)
+    finally:
+        shutil.rmtree(path)
+
+    try:
+        stages['project'], _ = best_time(lambda: project(sg), repeat)
+    except ImportError:
+        pass
+
+    stages['time_weighting'], matrix = best_time(
+        lambda: graph_matrix(sg, meters_per_minute(travel_speed)), repeat)
+
+    # Snap random locations within the network's extent.
+    lat = rng.uniform(np.min(sg.lat), np.max(sg.lat), 1000)
+    lon = rng.uniform(np.min(sg.lon), np.max(sg.lon), 1000)
+    stages['snap_points'], _ = best_time(lambda: snap_points(tree,
+        np.column_stack((lat, lon)), max_distance=np.inf), repeat)
+
+    candidates = rng.choice(n, min(num_candidates, n), replace=False)
+    stages['nearest_times'], _ = best_time(
+        lambda: nearest_times(matrix, candidates), repeat)
+    stages['bounded_times'], _ = best_time(
+        lambda: shortest_times(matrix, candidates, max(trip_times)),
+        repeat)
+
+    stages['coverage_bits'], bits = best_time(
+        lambda: coverage_bits(matrix, candidates, max(trip_times)),
+        repeat)
+    stages['combination_scoring'], _ = best_time(
+        lambda: top_combinations(bits, num_centers), repeat)
+
+    # Polygon building grows with the area reached, so it is
+    # only run on the smaller networks.
+    if n <= max_iso_nodes:
+        stages['polygons'], _ = best_time(lambda: make_iso_polys(sg,
+            matrix, candidates[:1], list(trip_times)), repeat)
+
+    return stages
+
+# Time importing a module in a fresh interpreter, as a
+# short-lived job would. Returns the best time in seconds
+# over repeat runs and the HEAVY_MODULES it loaded.
+def import_time(module, repeat=3):
+    code = ('import sys, time, json, importlib\n'
+        't = time.perf_counter()\n'
+        'importlib.import_module({!r})\n'
+        't = time.perf_counter() - t\n'
+        'print(json.dumps([t, [m for m in {!r} if m in sys.modules]]))'
+        ).format(module, HEAVY_MODULES)
+
+    best, loaded = np.inf, []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', code],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        seconds, loaded = json.loads(output)
+        best = min(best, seconds)
+    return best, loaded
+
+# Check the import time of every module in IMPORT_BUDGETS.
+# Returns a list of (module, seconds, budget, heavy modules
+# loaded) for every module over budget or loading any.
+def check_imports(repeat=3):
+    failures = []
+    for module, budget in IMPORT_BUDGETS.items():
+        seconds, loaded = import_time(module, repeat)
+        print('import {}: {:.3f}s (budget {:.1f}s){}'.format(module,
+            seconds, budget, ', loads ' + ', '.join(loaded)
+            if loaded else ''))
+        if seconds > budget or loaded:
+            failures.append((module, seconds, budget, loaded))
+    return failures
+
+# Describe the environment the benchmarks ran in.
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'],
+            capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    return {'python': platform.python_version(),
+        'numpy': np.__version__, 'scipy': scipy.__version__,
+        'platform': platform.platform(), 'commit': commit}
+
+# Run every generator at every size.
+def run(sizes, generators, seed=0, repeat=3):
+    results = []
+    for name in generators:
+        for size in sizes:
+            rng = np.random.default_rng(seed)
+            build_time, sg = best_time(
+                lambda: GENERATORS[name](size, rng), 1)
+            stages = bench_graph(sg, rng, repeat)
+            stages['generate'] = build_time
+
+            results.append({'generator': name, 'size': size,
+                'nodes': len(sg.x), 'edges': len(sg.indices),
+                'seed': seed, 'stages': stages})
+            print('{} {}: {}'.format(name, size, ', '.join(
+                '{} {:.4f}s'.format(stage, t)
+                for stage, t in stages.items())))
+
+    return {'environment': environment(), 'results': results}
+
+# Compare results against a baseline run. Returns a list
+# of (generator, size, stage, old time, new time) for every
+# stage that slowed down by more than threshold times.
+def compare(baseline, current, threshold=1.25):
+    old = {(r['generator'], r['size']): r['stages']
+        for r in baseline['results']}
+
+    regressions = []
+    for r in current['results']:
+        for stage, new_time in r['stages'].items():
+            old_time = old.get((r['generator'], r['size']), {}).get(stage)
+            if old_time is None:
+                continue
+
+            ratio = new_time / old_time if old_time > 0 else np.inf
+            print('{} {} {}: {:.4f}s -> {:.4f}s ({:.2f}x)'.format(
+                r['generator'], r['size'], stage, old_time, new_time,
+                ratio))
+            if ratio > threshold:
+                regressions.append((r['generator'], r['size'], stage,
+                    old_time, new_time))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the coverage pipeline on synthetic '
+        'street networks.')
+    parser.add_argument('--sizes', nargs='+', type=int,
+        default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--generators', nargs='+', default=list(GENERATORS),
+        choices=list(GENERATORS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--out', help='write results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON results')
+    parser.add_argument('--threshold', type=float, default=1.25,
+        help='slowdown ratio reported as a regression')
+    parser.add_argument('--imports', action='store_true',
+        help='only check import times against their budget')
+    args = parser.parse_args()
+
+    if args.imports:
+        failures = check_imports(args.repeat)
+        for module, seconds, budget, loaded in failures:
+            print('Over budget: {} {:.3f}s'.format(module, seconds))
+        if failures:
+            sys.exit(1)
+        return
+
+    results = run(args.sizes, args.generators, args.seed, args.repeat)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.threshold)
+        for generator, size, stage, old_time, new_time in regressions:
+            print('Regression: {} {} {} {:.4f}s -> {:.4f}s'.format(
+                generator, size, stage, old_time, new_time))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+################### CMCM 2018 ###################
+# Precompute the coverage of each candidate center
+# as a packed bit array so that combinations of
+# centers can be scored with bitwise operations.
+
+import heapq
+import itertools as it
+import math
+import time
+import numpy as np
+
+import instrument
+from routing import batched_times
+
+# Number of set bits in every possible byte.
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)],
+    dtype=np.uint8)
+
+################ Helper Functions ###############
+# Compute the nodes each candidate reaches within
+# trip_time once and pack them into bits, given the
+# routing matrix of edge times and the positions of the
+# candidates. Returns a (num candidates x num bytes) uint8
+# array where bit j of row i is set if candidate i reaches
+# node j. Rows are padded to a multiple of 8 bytes so they
+# may also be viewed as uint64 words.
+@instrument.timed('coverage_bits')
+def coverage_bits(matrix, center_nodes, trip_time):
+    num_bytes = -(-matrix.shape[0] // 64) * 8
+    bits = np.zeros((len(center_nodes), num_bytes), dtype=np.uint8)
+
+    for start, times in batched_times(matrix, center_nodes, trip_time):
+        pack_coverage(times <= trip_time, bits[start:start + len(times)])
+
+    return bits
+
+# Pack a (num candidates x num nodes) boolean array of the
+# nodes each candidate reaches into padded rows of bits, as
+# returned by coverage_bits. The rows are written to out if
+# given.
+def pack_coverage(reached, out=None):
+    if out is None:
+        num_bytes = -(-reached.shape[1] // 64) * 8
+        out = np.zeros((len(reached), num_bytes), dtype=np.uint8)
+
+    packed = np.packbits(reached, axis=1)
+    out[:, :packed.shape[1]] = packed
+    return out
+
+# Count the set bits along the last axis of a uint8 array.
+def popcount(bits):
+    return POPCOUNT[bits].sum(axis=-1, dtype=np.int64)
+
+# Score a batch of combinations, given as a (num combos x
+# num centers) array of candidate indices. Returns the
+# number of nodes covered by the union of each combination.
+def score_combinations(bits, combos):
+    words = bits.view(np.uint64)
+    union = np.bitwise_or.reduce(words[combos], axis=1)
+    return popcount(union.view(np.uint8))
+
+# Report the progress of a combination search.
+def print_progress(done, total, elapsed):
+    rate = done / elapsed if elapsed > 0 else 0
+    eta = (total - done) / rate if rate > 0 else float('inf')
+    print('Scored {} / {} combinations ({:.1f}%), {:.0f} per '
+        'second, {:.0f}s remaining'.format(done, total, 
+        100 * done / total, rate, eta))
+
+# Push the scored chunk of combinations, the first of which
+# has the given rank, onto a bounded min-heap of at most top
+# (coverage, -rank, combo) entries. Only combinations
+# strictly better than the worst one kept can enter a full
+# heap, since ties with it have a later rank.
+def push_top(heap, top, chunk, sizes, first_rank):
+    keep = np.arange(len(sizes))
+    if len(heap) == top:
+        keep = keep[sizes > heap[0][0]]
+    if len(keep) > top:
+        keep = keep[np.lexsort((keep, -sizes[keep]))[:top]]
+
+    for j in keep:
+        entry = (int(sizes[j]), -(first_rank + int(j)), 
+            tuple(int(c) for c in chunk[j]))
+        if len(heap) < top:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+
+# Lazily score every combination of num_centers candidates
+# in chunks, never holding more than chunk_size combinations
+# in memory, while keeping a bounded heap of the best `top`
+# seen so far. Combinations with equal coverage are ranked
+# by the order in which they are generated, so ties and
+# near-optimal alternatives are kept rather than only the
+# first maximum. If progress is given, it is called with
+# (done, total, elapsed seconds) every report_every seconds
+# and once at the end. Returns a list of (coverage, combo)
+# pairs from best to worst.
+@instrument.timed('combination_scoring')
+def top_combinations(bits, num_centers, top=10, chunk_size=65536,
+        progress=None, report_every=5):
+    total = math.comb(len(bits), num_centers)
+    combos = it.combinations(range(len(bits)), num_centers)
+
+    # Heap entries are (coverage, -rank, combo) so the root
+    # is the worst combination kept.
+    heap = []
+    done = 0
+    start = last_report = time.perf_counter()
+
+    while True:
+        chunk = np.fromiter(
+            it.chain.from_iterable(it.islice(combos, chunk_size)),
+            dtype=np.intp)
+        if len(chunk) == 0:
+            break
+
+        chunk = chunk.reshape(-1, num_centers)
+        sizes = score_combinations(bits, chunk)
+
+        push_top(heap, top, chunk, sizes, done)
+        done += len(chunk)
+        instrument.count('combinations_scored', len(chunk))
+        now = time.perf_counter()
+        if progress is not None and now - last_report >= report_every:
+            progress(done, total, now - start)
+            last_report = now
+
+    if progress is not None:
+        progress(done, total, time.perf_counter() - start)
+
+    return [(size, combo) for size, _, combo in sorted(heap, reverse=True)]
+
+# Find the combinations with the given lexicographic ranks
+# (the order used by itertools.combinations) without
+# enumerating the ones before them. Ranks are unranked in
+# the combinatorial number system, where the k-th element is
+# the largest c with C(c, k) <= rank, after mapping each
+# element x to n - 1 - x so that lexicographic order becomes
+# reverse colexicographic order. Returns a (num ranks x k)
+# array of candidate indices.
+def unrank_combinations(ranks, n, k):
+    total = math.comb(n, k)
+    rest = (total - 1) - np.asarray(ranks, dtype=np.int64)
+    combos = np.empty((len(rest), k), dtype=np.intp)
+
+    for j in range(k, 0, -1):
+        # C(c, j) for every c, clipped so it fits in int64.
+        table = np.array([min(math.comb(c, j), total) 
+            for c in range(n)], dtype=np.int64)
+        c = np.searchsorted(table, rest, side='right') - 1
+        rest -= table[c]
+        combos[:, k - j] = (n - 1) - c
+
+    return combos
+
+# Score the combinations with lexicographic ranks in
+# [start, stop), unranking them chunk by chunk. Returns a
+# list of at most top (coverage, -rank, combo) entries.
+def top_in_range(bits, num_centers, start, stop, top=10, 
+        chunk_size=65536):
+    heap = []
+    for first in range(start, stop, chunk_size):
+        ranks = np.arange(first, min(first + chunk_size, stop))
+        chunk = unrank_combinations(ranks, len(bits), num_centers)
+        sizes = score_combinations(bits, chunk)
+        push_top(heap, top, chunk, sizes, first)
+
+    return heap
+
+# Find the first combination of candidate indices with
+# maximum coverage. Returns it along with its coverage.
+def best_combination(bits, num_centers, chunk_size=65536):
+    results = top_combinations(bits, num_centers, top=1, 
+        chunk_size=chunk_size)
+    if not results:
+        return None, -1
+
+    size, combo = results[0]
+    return combo, size
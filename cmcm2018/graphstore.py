@@ -0,0 +1,168 @@
+################### CMCM 2018 ###################
+# Store projected street networks on disk as flat
+# arrays so later runs can load them (memory-mapped)
+# without downloading, projecting or rebuilding the
+# networkx graph. Each graph is saved to its own
+# directory of .npy files, keyed by place, network
+# type and projection:
+#   node_ids, lat, lon, x, y  - one entry per node
+#   indptr, indices, length   - CSR adjacency, with the
+#                               shortest length in meters
+#                               of any edge u -> v
+#   meta.json                 - place, network type, crs
+
+import os
+import json
+import hashlib
+from collections import namedtuple
+import numpy as np
+
+import instrument
+
+STORE_VERSION = 1
+
+ARRAYS = ['node_ids', 'lat', 'lon', 'x', 'y', 'indptr', 'indices',
+    'length']
+
+# A projected street network as flat arrays, where node i
+# has id node_ids[i] and its out edges are
+# indices[indptr[i]:indptr[i+1]].
+StreetGraph = namedtuple('StreetGraph', ARRAYS + ['crs'])
+
+################ Helper Functions ###############
+# Get the name of the directory a graph is stored in.
+def graph_key(place, network_type='drive', crs=None):
+    key = json.dumps([STORE_VERSION, place, network_type,
+        crs if crs is None else str(crs)])
+    name = ''.join(c if c.isalnum() else '_' for c in place)
+    return name[:40] + '_' + network_type + '_' + \
+        hashlib.sha1(key.encode()).hexdigest()[:12]
+
+# Convert a projected osmnx graph into a StreetGraph. The
+# latitude and longitude of each node are taken from the
+# unprojected graph G_latlon if given, or else from the
+# 'lat' and 'lon' attributes osmnx keeps when projecting.
+@instrument.timed('edge_arrays')
+def from_networkx(G, G_latlon=None):
+    nodes = list(G.nodes())
+    index = {node: i for i, node in enumerate(nodes)}
+    n = len(nodes)
+
+    node_data = G.nodes(data=True)
+    x = np.array([node_data[node]['x'] for node in nodes], dtype=float)
+    y = np.array([node_data[node]['y'] for node in nodes], dtype=float)
+    if G_latlon is not None:
+        lon = np.array([G_latlon.nodes[node]['x'] for node in nodes],
+            dtype=float)
+        lat = np.array([G_latlon.nodes[node]['y'] for node in nodes],
+            dtype=float)
+    else:
+        lon = np.array([node_data[node]['lon'] for node in nodes],
+            dtype=float)
+        lat = np.array([node_data[node]['lat'] for node in nodes],
+            dtype=float)
+
+    # Keep the shortest of any parallel edges.
+    u = np.array([index[a] for a, _ in G.edges()], dtype=np.int64)
+    v = np.array([index[b] for _, b in G.edges()], dtype=np.int64)
+    length = np.array([w for _, _, w in G.edges(data='length')],
+        dtype=float)
+    u, v, length = csr_edges(n, u, v, length)
+
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(u, minlength=n), out=indptr[1:])
+
+    crs = G.graph.get('crs')
+    return StreetGraph(np.array(nodes, dtype=np.int64), lat, lon,
+        x, y, indptr, v.astype(np.int32), length,
+        crs if crs is None or isinstance(crs, dict) else str(crs))
+
+# Sort edges by (u, v) and keep only the shortest of any
+# parallel edges. Returns the deduplicated arrays.
+def csr_edges(n, u, v, length):
+    order = np.lexsort((length, v, u))
+    u, v, length = u[order], v[order], length[order]
+    first = np.ones(len(u), dtype=bool)
+    first[1:] = (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+    return u[first], v[first], length[first]
+
+# Save a StreetGraph to the given directory.
+def save(sg, path, **meta):
+    os.makedirs(path, exist_ok=True)
+    for name in ARRAYS:
+        np.save(os.path.join(path, name + '.npy'), getattr(sg, name))
+
+    meta.update({'version': STORE_VERSION, 'crs': sg.crs,
+        'num_nodes': len(sg.node_ids), 'num_edges': len(sg.indices)})
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+# Load a StreetGraph from the given directory. If mmap is
+# set, arrays are memory-mapped rather than read.
+def load(path, mmap=True):
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta['version'] != STORE_VERSION:
+        raise ValueError('Unsupported graph store version ' +
+            str(meta['version']) + ' in ' + path)
+
+    arrays = [np.load(os.path.join(path, name + '.npy'),
+        mmap_mode='r' if mmap else None) for name in ARRAYS]
+    return StreetGraph(*arrays, crs=meta['crs'])
+
+# Download and project the street network of a place with
+# osmnx, returning it as a StreetGraph.
+def build_graph(place, network_type='drive', crs=None):
+    import osmnx as ox
+    ox.config(log_console=True, use_cache=True)
+
+    with instrument.stage('download'):
+        G = ox.graph_from_place(place, network_type=network_type)
+    with instrument.stage('project'):
+        G_proj = ox.project_graph(G, to_crs=crs)
+    return from_networkx(G_proj, G)
+
+# Get the directory a graph is stored in within cache_dir.
+def graph_path(place, network_type='drive', crs=None,
+        cache_dir='graph_cache'):
+    return os.path.join(cache_dir, graph_key(place, network_type, crs))
+
+# Load the projected street network of a place from the
+# store in cache_dir, building and saving it on first use.
+@instrument.timed('load_graph')
+def load_graph(place, network_type='drive', crs=None,
+        cache_dir='graph_cache', mmap=True):
+    path = graph_path(place, network_type, crs, cache_dir)
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        sg = build_graph(place, network_type, crs)
+        save(sg, path, place=place, network_type=network_type)
+
+    return load(path, mmap)
+
+# Time in minutes to traverse each edge of a StreetGraph.
+def edge_times(sg, meters_per_minute):
+    return np.asarray(sg.length) / meters_per_minute
+
+# Rebuild a networkx MultiDiGraph from a StreetGraph for
+# code that still needs one, with node positions, edge
+# lengths and, if meters_per_minute is given, edge times.
+def to_networkx(sg, meters_per_minute=None, name='graph'):
+    import networkx as nx
+
+    G = nx.MultiDiGraph(crs=sg.crs, name=name)
+    node_ids = sg.node_ids.tolist()
+    G.add_nodes_from((node, {'osmid': node, 'x': x, 'y': y, 
+        'lon': lon, 'lat': lat})
+        for node, x, y, lon, lat in zip(node_ids, sg.x.tolist(),
+        sg.y.tolist(), sg.lon.tolist(), sg.lat.tolist()))
+
+    u = np.repeat(np.arange(len(node_ids)), np.diff(sg.indptr))
+    attrs = [{'length': length} for length in sg.length.tolist()]
+    if meters_per_minute is not None:
+        for data, time in zip(attrs,
+                edge_times(sg, meters_per_minute).tolist()):
+            data['time'] = time
+
+    G.add_edges_from((node_ids[a], node_ids[b], data)
+        for a, b, data in zip(u.tolist(), sg.indices.tolist(), attrs))
+    return G
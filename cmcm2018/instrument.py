@@ -0,0 +1,150 @@
+################### CMCM 2018 ###################
+# Per-stage timing, call counters and memory peaks
+# for the cmcm2018 pipeline. Instrumentation is off
+# unless enabled, in which case stages and counters
+# only cost a flag check. Enable it with enable() or
+# by setting the environment variable
+#   CMCM_INSTRUMENT=1          report to stderr at exit
+#   CMCM_INSTRUMENT=file.json  write report at exit
+#   CMCM_TRACEMALLOC=1         also trace allocations
+# Stages are timed with
+#   with instrument.stage('name'): ...
+#   @instrument.timed('name')
+# and events counted with instrument.count('name', n).
+
+import os
+import sys
+import json
+import time
+import atexit
+import functools
+import contextlib
+import tracemalloc
+from collections import Counter, defaultdict
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+enabled = False
+trace_memory = False
+
+# Totals for each stage and counter, and the stack of
+# stages currently running.
+stages = defaultdict(lambda: {'calls': 0, 'seconds': 0.0,
+    'peak_traced_bytes': 0})
+counters = Counter()
+stack = []
+
+################ Helper Functions ###############
+# Turn instrumentation on, optionally tracing allocations
+# with tracemalloc to record each stage's peak memory.
+def enable(trace=False):
+    global enabled, trace_memory
+    enabled = True
+    trace_memory = trace
+    if trace and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+# Turn instrumentation off.
+def disable():
+    global enabled, trace_memory
+    enabled = False
+    if trace_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    trace_memory = False
+
+# Clear all recorded stages and counters.
+def reset():
+    stages.clear()
+    counters.clear()
+    del stack[:]
+
+# Add n to the named counter.
+def count(name, n=1):
+    if enabled:
+        counters[name] += n
+
+@contextlib.contextmanager
+def running_stage(name):
+    frame = {'peak': 0}
+    if trace_memory:
+        # The peak so far belongs to the enclosing stage.
+        if stack:
+            stack[-1]['peak'] = max(stack[-1]['peak'],
+                tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+
+    stack.append(frame)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stack.pop()
+
+        totals = stages[name]
+        totals['calls'] += 1
+        totals['seconds'] += elapsed
+
+        if trace_memory:
+            peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+            totals['peak_traced_bytes'] = max(
+                totals['peak_traced_bytes'], peak)
+            if stack:
+                stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+
+# Time the named stage as a context manager. Returns a
+# shared no-op context when instrumentation is off.
+def stage(name):
+    if not enabled:
+        return contextlib.nullcontext()
+    return running_stage(name)
+
+# Time every call of the decorated function as the named
+# stage.
+def timed(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with running_stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Peak resident set size of this process in bytes, or None
+# where it cannot be measured.
+def peak_rss():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+# Get a structured report of every stage and counter.
+def report():
+    return {
+        'stages': {name: dict(totals) for name, totals in stages.items()},
+        'counters': dict(counters),
+        'trace_memory': trace_memory,
+        'peak_rss_bytes': peak_rss(),
+    }
+
+# Write the report as JSON to the given path, or to stderr.
+def emit(path=None):
+    text = json.dumps(report(), indent=2)
+    if path:
+        with open(path, 'w') as f:
+            f.write(text)
+    else:
+        print(text, file=sys.stderr)
+
+# Enable instrumentation from the environment and emit the
+# report when the process exits.
+setting = os.environ.get('CMCM_INSTRUMENT')
+if setting:
+    enable(trace=bool(os.environ.get('CMCM_TRACEMALLOC')))
+    atexit.register(emit, None if setting == '1' else setting)
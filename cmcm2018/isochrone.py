@@ -7,71 +7,18 @@
 # File Location: osmnx-examples/notebooks/
 #                13-isolines-isochrones.ipynb
 
-import osmnx as ox
-import networkx as nx
-import geopandas as gpd
-import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
-import matplotlib.lines as mlines
-from shapely.geometry import Point, LineString, Polygon
-from descartes import PolygonPatch
+import json
+import numpy as np
 
-################ Helper Functions ###############
-# Create the polygons of the isochrone to plot. Returns
-# array of arrays of polygons, with one array corresponding
-# to each center.
-def make_iso_polys(G, centers, trip_times):
-    # Define the width of the polygons around
-    #  edges and nodes.
-    edge_buff = 40
-    node_buff = 25
-
-    # Init array to store polygons.
-    isochrone_polys = [[None]] * len(centers)
-    
-    # For each center, create the corresponding 
-    # polygon for the specified travel time.
-    for i in range(0, len(centers)):
-
-        isochrone_polys[i] = []
-        for trip_time in sorted(trip_times, reverse=True):
-
-            # Generate the subgraph.
-            subgraph = nx.ego_graph(G, centers[i], 
-                radius=trip_time, distance='time')
-
-            # Format the data from the subgraph into 
-            # data frames.
-            node_points = [Point((data['x'], data['y'])) for
-                node, data in subgraph.nodes(data=True)]
-            nodes_gdf = gpd.GeoDataFrame({'id': subgraph.nodes()}, 
-                geometry=node_points)
-            nodes_gdf = nodes_gdf.set_index('id')
-
-            # Get edges that the isochrone encapsulates.
-            edge_lines = []
-            for n_fr, n_to in subgraph.edges():
-                f = nodes_gdf.loc[n_fr].geometry
-                t = nodes_gdf.loc[n_to].geometry
-                edge_lines.append(LineString([f,t]))
-
-            # Construct the poygon that represents the 
-            # isochrone.
-            n = nodes_gdf.buffer(node_buff).geometry
-            e = gpd.GeoSeries(edge_lines).buffer(edge_buff).geometry
-            all_gs = list(n) + list(e)
-            new_iso = Polygon(gpd.GeoSeries(all_gs).unary_union)
-
-            # Try to fill in surrounded areas so shapes 
-            # will appear solid and blocks without white 
-            # space inside them.
-            new_iso = Polygon(new_iso.exterior)
-            isochrone_polys[i].append(new_iso)
-            
-    return isochrone_polys
+from polygons import make_iso_polys, parallel_iso_polys, iso_features
+from isostore import cached_iso_polys
+from raster import raster_iso_polys
+from graphstore import load_graph, graph_path, to_networkx
+from snapping import load_index, snap_points
+from traveltimes import meters_per_minute
+from routing import graph_matrix
 
 ################# Initial Setup #################
-ox.config(log_console=True, use_cache=True)
 title = 'Isochrone'
 
 # Configure the place, network type, trip times, and travel speed.
@@ -85,75 +32,145 @@ network_type = 'drive'
 trip_times = [3,4,5,6,7,8,9,10] # In minutes.
 travel_speed = 10 # In mph.
 
-################ Graph Processing ###############
-
-# Download the street network.
-G = ox.graph_from_place(place, network_type=network_type)
-
-# Find nearest locations on graph to centers 
-# defined above.
-for i in range(0, len(centers)): 
-    centers[i] = ox.get_nearest_node(G, centers[i])
-
-G = ox.project_graph(G)
-
-# Miles per hour to meter per minute.
-meters_per_minute = (travel_speed * 5280 * 12 * 2.54) / (100 * 60)
-
-# Add an edge attribute for time in minutes 
-# required to traverse each edge.
-for u, v, k, data in G.edges(data=True, keys=True):
-    data['time'] = data['length'] / meters_per_minute
-
-################ Plotting Results ###############
+# Directory of the graph store.
+cache_dir = 'graph_cache'
 
-# Get one color for each isochrone polygon level.
-# Note that we split the color map about 6 to 
-# highlight what levels are within our tolerance.
-six_min_loc = trip_times.index(6) + 1
+# GeoJSON file to write the polygons to instead of plotting
+# them, for headless runs, or None to plot.
+out_file = None
 
-iso_colors = ox.get_colors(n=len(trip_times)-six_min_loc, 
-    cmap='Oranges', start=0.3, stop=0.7, return_hex=True)[::-1]
+# Either 'vector', which buffers the nodes and edges reached
+# in each band, or 'raster', which contours every band from
+# a grid of travel times.
+mode = 'vector'
 
-iso_colors += ox.get_colors(n=six_min_loc, 
-    cmap='Greens', start=0.3, stop=1.0, return_hex=True)
+# With the 'raster' mode, a .npy file to save each center's
+# grid of travel times to for heatmaps, or None.
+grid_file = None
 
-# Only show the nodes corresponding to the 
-# centers as black.
-node_color = ['k' if node in centers else 'none' 
-    for node in G.nodes()]
-node_size = [30 if node in centers else 0 
-    for node in G.nodes()]
+# Number of worker processes building the polygons of each
+# center in the 'vector' mode, or None to use every core.
+processes = 1
 
-# Create figure from graph.
-fig, ax = ox.plot_graph(G, fig_height=6, show=False, 
-    close=False, edge_color='k', edge_alpha=0.3, 
-    node_color=node_color, node_size=node_size)
+# GeoPackage (.gpkg) or GeoJSON (.geojson) file the polygons
+# are saved to and loaded from, keyed by center, speed,
+# trip time and mode, so that later runs only build centers
+# missing from it, or None.
+iso_store = None
 
-isochrone_polys = make_iso_polys(G, centers, trip_times)
-
-# Plot each poly for each isochrone beginning at the 
-# lowest level (the longest travel time).
-for i in range(0, len(trip_times)):
-    for iso_polys in isochrone_polys:
-        # Add polygon to plot.
-        patch = PolygonPatch(iso_polys[i], fc=iso_colors[i], 
-            ec='none', alpha=0.85, zorder=-1)
-        ax.add_patch(patch)
-
-# Create custom label with trip lengths 
-# corresponding to colors.
-time_labels = [str(trip_time) + ' min' 
-    for trip_time in trip_times]
-handles = [mpatches.Patch(color=color, label=label) 
-    for color, label in zip(iso_colors[::-1], time_labels)]
-
-# Add marker for starting location to legend.
-handles = [mlines.Line2D([],[], marker='.', markersize=15,
-    linewidth=0, color='k', label='Starting Location')] + handles
-
-ax.legend(handles=handles, loc='center right', fontsize='small')
-
-# Display final result.
-# fig.suptitle(title, fontsize=12)
-plt.show()
+################ Helper Functions ###############
+# Plot the isochrone polygons from make_iso_polys over a
+# graphstore.StreetGraph, marking the center positions.
+def plot_isochrones(sg, center_nodes, isochrone_polys, trip_times,
+        name='graph'):
+    import osmnx as ox
+    import matplotlib.patches as mpatches
+    import matplotlib.lines as mlines
+    from descartes import PolygonPatch
+
+    # Get one color for each isochrone polygon level.
+    # Note that we split the color map about 6 to 
+    # highlight what levels are within our tolerance.
+    six_min_loc = trip_times.index(6) + 1
+
+    iso_colors = ox.get_colors(n=len(trip_times)-six_min_loc, 
+        cmap='Oranges', start=0.3, stop=0.7, return_hex=True)[::-1]
+
+    iso_colors += ox.get_colors(n=six_min_loc, 
+        cmap='Greens', start=0.3, stop=1.0, return_hex=True)
+
+    # Only show the nodes corresponding to the 
+    # centers as black.
+    is_center = np.isin(np.arange(len(sg.node_ids)), center_nodes)
+    node_color = ['k' if center else 'none' for center in is_center]
+    node_size = [30 if center else 0 for center in is_center]
+
+    # Create figure from graph, which is only rebuilt for 
+    # plotting.
+    G = to_networkx(sg, name=name)
+    fig, ax = ox.plot_graph(G, fig_height=6, show=False, 
+        close=False, edge_color='k', edge_alpha=0.3, 
+        node_color=node_color, node_size=node_size)
+
+    # Plot each poly for each isochrone beginning at the 
+    # lowest level (the longest travel time).
+    for i in range(0, len(trip_times)):
+        for iso_polys in isochrone_polys:
+            # Add polygon to plot.
+            patch = PolygonPatch(iso_polys[i], fc=iso_colors[i], 
+                ec='none', alpha=0.85, zorder=-1)
+            ax.add_patch(patch)
+
+    # Create custom label with trip lengths 
+    # corresponding to colors.
+    time_labels = [str(trip_time) + ' min' 
+        for trip_time in trip_times]
+    handles = [mpatches.Patch(color=color, label=label) 
+        for color, label in zip(iso_colors[::-1], time_labels)]
+
+    # Add marker for starting location to legend.
+    handles = [mlines.Line2D([],[], marker='.', markersize=15,
+        linewidth=0, color='k', label='Starting Location')] + handles
+
+    ax.legend(handles=handles, loc='center right', fontsize='small')
+    return fig, ax
+
+
+def main():
+    ############### Graph Processing ##############
+
+    # Load the projected street network from the graph store,
+    # downloading and projecting it only on the first run.
+    sg = load_graph(place, network_type, cache_dir=cache_dir)
+
+    # Snap the centers defined above to the positions of
+    # their nearest nodes on the graph, warning about any
+    # that are far from the network.
+    tree = load_index(sg, graph_path(place, network_type, 
+        cache_dir=cache_dir))
+    center_nodes = snap_points(tree, centers)[0].tolist()
+
+    # Build the routing matrix of the time in minutes 
+    # required to traverse each edge.
+    matrix = graph_matrix(sg, meters_per_minute(travel_speed))
+
+    ############### Plotting Results ##############
+    # Build the polygons of the given center positions.
+    def build(center_nodes):
+        if mode == 'vector' and processes == 1:
+            return make_iso_polys(sg, matrix, center_nodes, trip_times)
+        elif mode == 'vector':
+            return parallel_iso_polys(sg, matrix, center_nodes, 
+                trip_times, processes)
+        elif mode == 'raster':
+            return raster_iso_polys(sg, matrix, center_nodes, 
+                trip_times, grid_file=grid_file)
+        else:
+            raise ValueError('Unknown mode: ' + str(mode))
+
+    if iso_store is not None:
+        isochrone_polys = cached_iso_polys(iso_store, sg, center_nodes, 
+            travel_speed, trip_times, build, mode, rings=False,
+            partial=True)
+    else:
+        isochrone_polys = build(center_nodes)
+
+    if out_file is not None:
+        with open(out_file, 'w') as f:
+            json.dump({'type': 'FeatureCollection', 
+                'features': iso_features(sg.crs, isochrone_polys, 
+                trip_times, [{'center': center} for center in centers])}, 
+                f)
+        return
+
+    import matplotlib.pyplot as plt
+    fig, ax = plot_isochrones(sg, center_nodes, isochrone_polys, 
+        trip_times, place)
+
+    # Display final result.
+    # fig.suptitle(title, fontsize=12)
+    plt.show()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+################### CMCM 2018 ###################
+# Save isochrone polygons to a GeoPackage (.gpkg) or
+# GeoJSON (.geojson) file with one feature per center,
+# travel speed and trip time, so that later runs and
+# plots load them rather than rebuilding them. Each
+# feature holds the osm id and location of its center
+# node, the speed in mph, the trip time in minutes and how
+# the polygons were built: the mode ('vector' or 'raster')
+# and the rings and partial settings.
+# GeoPackages keep the graph's projected crs, while
+# GeoJSON files are written in latitude and longitude.
+
+import os
+
+# Columns identifying each polygon of a store.
+KEYS = ['node', 'speed', 'trip_time', 'mode', 'rings', 'partial']
+
+DRIVERS = {'.gpkg': 'GPKG', '.geojson': 'GeoJSON', '.json': 'GeoJSON'}
+
+################ Helper Functions ###############
+# Get the driver to write a store with from its extension.
+def store_driver(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in DRIVERS:
+        raise ValueError('Unknown isochrone store format: ' + ext)
+    return DRIVERS[ext]
+
+# Build a GeoDataFrame of the polygons from make_iso_polys
+# of the centers at the given positions of a
+# graphstore.StreetGraph, built in the given mode with the
+# given rings and partial settings.
+def iso_frame(sg, center_nodes, travel_speed, trip_times,
+        isochrone_polys, mode='vector', rings=False, partial=True):
+    import geopandas as gpd
+
+    rows = []
+    for center, polys in zip(center_nodes, isochrone_polys):
+        for trip_time, poly in zip(sorted(trip_times)[::-1], polys):
+            rows.append({'node': int(sg.node_ids[center]),
+                'lat': float(sg.lat[center]), 'lon': float(sg.lon[center]),
+                'speed': float(travel_speed),
+                'trip_time': float(trip_time), 'mode': str(mode),
+                'rings': bool(rings), 'partial': bool(partial),
+                'geometry': poly})
+
+    return gpd.GeoDataFrame(rows, columns=KEYS[:1] + ['lat', 'lon'] +
+        KEYS[1:] + ['geometry'], geometry='geometry', crs=sg.crs)
+
+# Read every polygon of a store in the crs of the graph, or
+# None if the store does not exist yet. Key columns missing
+# from older stores are left empty, so their polygons never
+# match a lookup.
+def read_store(path, crs):
+    import geopandas as gpd
+
+    if not os.path.exists(path):
+        return None
+    frame = gpd.read_file(path)
+    for key in KEYS:
+        if key not in frame:
+            frame[key] = None
+    return frame.to_crs(crs) if frame.crs is not None else \
+        frame.set_crs(crs)
+
+# Add the polygons from make_iso_polys to a store, replacing
+# any already saved for the same center, speed, trip time,
+# mode, rings and partial settings. The store is rewritten to a temporary file which
+# then replaces it, so readers never see a partial file.
+def save_iso_polys(path, sg, center_nodes, travel_speed, trip_times,
+        isochrone_polys, mode='vector', rings=False, partial=True):
+    import pandas as pd
+
+    frame = iso_frame(sg, center_nodes, travel_speed, trip_times,
+        isochrone_polys, mode, rings, partial)
+    saved = read_store(path, sg.crs)
+    if saved is not None:
+        keys = pd.MultiIndex.from_frame(frame[KEYS])
+        stale = pd.MultiIndex.from_frame(saved[KEYS]).isin(keys)
+        frame = pd.concat([saved[~stale], frame], ignore_index=True)
+
+    driver = store_driver(path)
+    if driver == 'GeoJSON':
+        frame = frame.to_crs('EPSG:4326')
+
+    root, ext = os.path.splitext(path)
+    temp = root + '.tmp' + ext
+    frame.to_file(temp, driver=driver)
+    os.replace(temp, path)
+
+# Load the polygons of each center from a store, in the
+# order returned by make_iso_polys. Returns a list with the
+# polygons of each center, or None for centers missing any
+# of the trip times at this speed, mode, rings and partial
+# settings.
+def load_iso_polys(path, sg, center_nodes, travel_speed, trip_times,
+        mode='vector', rings=False, partial=True):
+    from shapely.geometry import Polygon
+
+    saved = read_store(path, sg.crs)
+    if saved is None:
+        return [None] * len(center_nodes)
+
+    saved = saved[(saved['speed'] == float(travel_speed)) &
+        (saved['mode'] == str(mode)) & (saved['rings'] == bool(rings)) &
+        (saved['partial'] == bool(partial))]
+    polys = {(int(node), float(trip_time)): geom
+        for node, trip_time, geom in zip(saved['node'],
+            saved['trip_time'], saved.geometry)}
+
+    isochrone_polys = []
+    for center in center_nodes:
+        node = int(sg.node_ids[center])
+        keys = [(node, float(t)) for t in sorted(trip_times)[::-1]]
+        if all(key in polys for key in keys):
+            isochrone_polys.append([polys[key] if polys[key] is not None
+                else Polygon() for key in keys])
+        else:
+            isochrone_polys.append(None)
+
+    return isochrone_polys
+
+# Load the polygons of each center from a store, building
+# only the centers missing from it with build(center_nodes),
+# which returns their polygons as make_iso_polys does in
+# the given mode with the given rings and partial settings,
+# and saving them to the store.
+def cached_iso_polys(path, sg, center_nodes, travel_speed, trip_times,
+        build, mode='vector', rings=False, partial=True):
+    isochrone_polys = load_iso_polys(path, sg, center_nodes,
+        travel_speed, trip_times, mode, rings, partial)
+    missing = [i for i, polys in enumerate(isochrone_polys)
+        if polys is None]
+
+    if missing:
+        built = build([center_nodes[i] for i in missing])
+        save_iso_polys(path, sg, [center_nodes[i] for i in missing],
+            travel_speed, trip_times, built, mode, rings, partial)
+        for i, polys in zip(missing, built):
+            isochrone_polys[i] = polys
+
+    return isochrone_polys
@@ -5,86 +5,205 @@
 # of Ithaca within some given timeframe.
 
 import itertools as it
-import osmnx as ox
-import networkx as nx
-import geopandas as gpd
-import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
-import matplotlib.lines as mlines
-from shapely.geometry import Point, LineString, Polygon
-from descartes import PolygonPatch
+
+import instrument
+from coverage import coverage_bits, top_combinations, print_progress
+from solvers import (SOLVERS, greedy_bound, parallel_top_combinations,
+    branch_and_bound_search)
+from graphstore import load_graph, graph_path, to_networkx
+from snapping import load_index, snap_points
+from traveltimes import meters_per_minute
+from routing import graph_matrix
 
 ################# Initial Setup #################
-ox.config(log_console=True, use_cache=True)
 
 # Configure the place, network type, trip times, and travel speed.
 place = 'Ithaca, NY, USA'
 centers = [(42.46089, -76.50496), (42.45444, -76.51536),
-    (42.45233, -76.49427), (42.44400, 76.47969),
+    (42.45233, -76.49427), (42.44400, -76.47969),
     (42.43267, -76.48417), (42.43917, -76.50247),
     (42.43934, -76.51246), (42.44795, -76.51619),
     (42.43713, -76.51752)]
 
-# [(42.440853, -76.509350), (42.461354, -76.492477), 
+# [(42.440853, -76.509350), (42.461354, -76.492477),
 #     (42.44034,-76.493039), (42.442098,-76.524386)]
 network_type = 'drive'
 trip_time = 6 # In minutes.
 travel_speed = 10 # In mph.
 num_centers = 6
 
-################ Graph Processing ###############
-
-# Download the street network.
-G = ox.graph_from_place(place, network_type=network_type)
-
-# Find nearest locations on graph to centers 
-# defined above.
-center_nodes = [0] * len(centers)
-for i in range(0, len(centers)): 
-    center_nodes[i] = ox.get_nearest_node(G, centers[i])
-
-G = ox.project_graph(G)
-
-# Miles per hour to meter per minute.
-meters_per_minute = (travel_speed * 5280 * 12 * 2.54) / (100 * 60)
-
-# Add an edge attribute for time in minutes required to 
-# traverse each edge.
-for u, v, k, data in G.edges(data=True, keys=True):
-    data['time'] = data['length'] / meters_per_minute
-
-#################### Optimize ###################
-
-# Zip centers and center_nodes to preserve relation 
-# in location.
-combinations = list(
-    it.combinations(zip(centers, center_nodes), num_centers))
-
-# Init list for sizes of the subgraphs.
-sub_sizes = [0] * len(combinations)
-
-# For each combination, calculate the size of the coverage 
-# by finding how many nodes the union of all subgraphs 
-# reach within the specified time.
-for i in range(0, len(combinations)):
-    subgraph = nx.Graph()
-    for center, center_node in combinations[i]:
-
-        # Add all nodes of subgraph from the current 
-        # center to the total converage, avoiding 
-        # repetitions.
-        subgraph.add_nodes_from(nx.ego_graph(G, center_node, 
-            radius=trip_time, distance='time').nodes())
-    
-    sub_sizes[i] = subgraph.number_of_nodes()
-
-# Find the maximum coverage and get corresponding 
-# combination.
-max_size = max(sub_sizes)
-max_combo = combinations[sub_sizes.index(max_size)]
-
-# Output data.
-print(max_combo)
-print('Percent Coverage = ' + 
-    str(max_size / G.number_of_nodes()))
-
+# Directory of the graph store.
+cache_dir = 'graph_cache'
+
+# Either 'bitset', which computes each candidate's coverage
+# once and scores combinations with bitwise operations, or
+# 'ego_graph', which recomputes coverage per combination.
+method = 'bitset'
+
+# Solver used with the 'bitset' method, one of 'brute'
+# (exhaustive), 'parallel' (exhaustive across processes),
+# 'bnb' (exact branch and bound), 'greedy' (lazy greedy,
+# within 1 - 1/e of optimal) or 'ilp' (exact integer
+# program).
+solver = 'brute'
+
+# Number of best combinations to report with the 'brute'
+# and 'parallel' solvers, including ties and near-optimal
+# alternatives.
+num_best = 5
+
+# Number of worker processes for the 'parallel' solver, or
+# None to use every core.
+processes = None
+
+################ Helper Functions ###############
+# Find the combinations of num_centers of the candidates
+# that reach the most nodes within trip_time, given a
+# graphstore.StreetGraph, its routing matrix of edge times
+# and the positions of the candidates. Returns a dict with
+# 'best', a list of (coverage, candidate indices) pairs
+# from best to worst, which holds up to num_best entries
+# with the 'brute' and 'parallel' solvers and one entry
+# otherwise, along with 'explored' and 'pruned' for the
+# 'bnb' solver and 'bound' for the 'greedy' solver. Raises a
+# ValueError unless num_centers is between 1 and the number
+# of candidates.
+def optimize_centers(sg, matrix, center_nodes, num_centers, trip_time,
+        method='bitset', solver='brute', num_best=5, processes=None,
+        travel_speed=10, progress=None):
+    if not 0 < num_centers <= len(center_nodes):
+        raise ValueError('num_centers must be between 1 and ' +
+            str(len(center_nodes)))
+
+    result = {}
+    if method == 'bitset':
+        # Compute the coverage of every candidate once and
+        # score all combinations against it.
+        bits = coverage_bits(matrix, center_nodes, trip_time)
+
+        if solver == 'brute':
+            # Stream through every combination, keeping only the
+            # best num_best and reporting progress along the way.
+            result['best'] = top_combinations(bits, num_centers,
+                top=num_best, progress=progress)
+        elif solver == 'parallel':
+            result['best'] = parallel_top_combinations(bits,
+                num_centers, top=num_best, processes=processes,
+                progress=progress)
+        elif solver == 'bnb':
+            max_indices, max_size, result['explored'], \
+                result['pruned'] = branch_and_bound_search(bits,
+                num_centers)
+            result['best'] = [(max_size, max_indices)]
+        elif solver in SOLVERS:
+            max_indices, max_size = SOLVERS[solver](bits, num_centers)
+            result['best'] = [(max_size, max_indices)]
+        else:
+            raise ValueError('Unknown solver: ' + str(solver))
+
+        if solver == 'greedy':
+            result['bound'] = greedy_bound(max_size, num_centers)
+
+    elif method == 'ego_graph':
+        result['best'] = [ego_graph_search(sg, center_nodes,
+            num_centers, trip_time, travel_speed)]
+
+    else:
+        raise ValueError('Unknown method: ' + str(method))
+
+    return result
+
+# Reference method recomputing the coverage of every
+# combination with networkx. Returns the best (coverage,
+# candidate indices) pair.
+def ego_graph_search(sg, center_nodes, num_centers, trip_time,
+        travel_speed):
+    import networkx as nx
+
+    # Rebuild the networkx graph for this reference method.
+    G = to_networkx(sg, meters_per_minute(travel_speed))
+    center_nodes = [int(sg.node_ids[i]) for i in center_nodes]
+
+    # Keep the index of each center to preserve relation
+    # in location.
+    combinations = list(
+        it.combinations(enumerate(center_nodes), num_centers))
+
+    # Init list for sizes of the subgraphs.
+    sub_sizes = [0] * len(combinations)
+
+    # For each combination, calculate the size of the coverage
+    # by finding how many nodes the union of all subgraphs
+    # reach within the specified time.
+    for i in range(0, len(combinations)):
+        subgraph = nx.Graph()
+        for index, center_node in combinations[i]:
+
+            # Add all nodes of subgraph from the current
+            # center to the total converage, avoiding
+            # repetitions.
+            instrument.count('ego_graph_calls')
+            with instrument.stage('ego_graph'):
+                subgraph.add_nodes_from(nx.ego_graph(G, center_node,
+                    radius=trip_time, distance='time').nodes())
+
+        sub_sizes[i] = subgraph.number_of_nodes()
+
+    # Find the maximum coverage and get corresponding
+    # combination.
+    max_size = max(sub_sizes)
+    max_combo = combinations[sub_sizes.index(max_size)]
+    return max_size, tuple(index for index, _ in max_combo)
+
+
+def main():
+    ############### Graph Processing ##############
+
+    # Load the projected street network from the graph store,
+    # downloading and projecting it only on the first run.
+    sg = load_graph(place, network_type, cache_dir=cache_dir)
+
+    # Snap the centers defined above to the positions of
+    # their nearest nodes on the graph, warning about any
+    # that are far from the network.
+    tree = load_index(sg, graph_path(place, network_type,
+        cache_dir=cache_dir))
+    center_nodes = snap_points(tree, centers)[0].tolist()
+    num_nodes = len(sg.node_ids)
+
+    # Build the routing matrix of the time in minutes
+    # required to traverse each edge.
+    matrix = graph_matrix(sg, meters_per_minute(travel_speed))
+
+    ################### Optimize ##################
+    result = optimize_centers(sg, matrix, center_nodes, num_centers,
+        trip_time, method, solver, num_best, processes, travel_speed,
+        progress=print_progress)
+
+    max_size, max_indices = result['best'][0]
+    max_combo = tuple((centers[i], int(sg.node_ids[center_nodes[i]]))
+        for i in max_indices)
+
+    # Output data.
+    print(max_combo)
+    print('Percent Coverage = ' +
+        str(max_size / num_nodes))
+
+    if len(result['best']) > 1:
+        print('Alternatives:')
+        for size, indices in result['best'][1:]:
+            print(tuple(centers[i] for i in indices))
+            print('Percent Coverage = ' +
+                str(size / num_nodes))
+
+    if 'explored' in result:
+        print('Nodes Explored = ' + str(result['explored']))
+        print('Nodes Pruned = ' + str(result['pruned']))
+
+    if 'bound' in result:
+        print('Optimal Coverage <= ' +
+            str(result['bound'] / num_nodes))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+################### CMCM 2018 ###################
+# Vectorized construction of isochrone polygons
+# from the travel times of the routing module and
+# arrays of node coordinates, using the array
+# interface of shapely 2.
+
+import multiprocessing as mp
+import numpy as np
+import shapely
+from shapely.geometry import Polygon, MultiPolygon, mapping
+
+import instrument
+from routing import edge_sources, shortest_times
+
+# Graph and routing matrix shared with each worker process.
+worker_graph = None
+worker_matrix = None
+
+################ Helper Functions ###############
+# Get the projected coordinates of every node of a
+# graphstore.StreetGraph as an (n x 2) array indexed by
+# node position.
+def node_coords(sg):
+    return np.column_stack((sg.x, sg.y)).astype(float)
+
+# Get the end points of the travelled part of each edge,
+# given the coordinates of its start and end nodes and the
+# fraction of it travelled.
+def cut_segments(starts, ends, fractions):
+    return starts + np.asarray(fractions)[:, None] * (ends - starts)
+
+# Fill in the holes of a polygon, or of every part of a
+# multipolygon, so shapes appear solid.
+def fill_holes(geom):
+    if isinstance(geom, MultiPolygon):
+        return MultiPolygon([Polygon(part.exterior)
+            for part in geom.geoms])
+    if isinstance(geom, Polygon) and not geom.is_empty:
+        return Polygon(geom.exterior)
+    return geom
+
+# Buffer every point and segment, given as (n x 2) arrays
+# of points and of segment start and end points, in bulk.
+# Returns an array of the buffered geometries.
+def buffer_geometry(points, starts, ends, node_buff=25,
+        edge_buff=40, quad_segs=16):
+    nodes = shapely.buffer(shapely.points(points), node_buff,
+        quad_segs=quad_segs)
+    lines = shapely.linestrings(np.stack((starts, ends), axis=1))
+    edges = shapely.buffer(lines, edge_buff, quad_segs=quad_segs)
+    return np.concatenate((nodes, edges))
+
+# Construct the polygon around the given points and segments
+# with a single union of their buffers, filling any holes.
+def iso_polygon(points, starts, ends, node_buff=25, edge_buff=40):
+    buffers = buffer_geometry(points, starts, ends,
+        node_buff, edge_buff)
+    instrument.count('unions')
+    with instrument.stage('union'):
+        return fill_holes(shapely.union_all(buffers))
+
+# Construct nested polygons from the geometry first added in
+# each band, given as a list of (points, starts, ends) from
+# the smallest band to the largest. Each point and segment is
+# buffered once and each band is the union of the previous
+# band with its own buffers. Returns the list of polygons
+# from the smallest band to the largest.
+def nested_polygons(deltas, node_buff=25, edge_buff=40):
+    polys = []
+    current = Polygon()
+    for points, starts, ends in deltas:
+        buffers = buffer_geometry(points, starts, ends,
+            node_buff, edge_buff)
+
+        # Holes enclosed by one band are still enclosed once
+        # more is added, so the filled band can be carried.
+        instrument.count('unions')
+        with instrument.stage('union'):
+            current = fill_holes(shapely.union_all(
+                np.append(buffers, current)))
+        polys.append(current)
+
+    return polys
+
+# Difference each of a list of nested polygons, ordered from
+# smallest to largest, with the one before it, giving the
+# ring covered by each band alone.
+def ring_polygons(polys):
+    return polys[:1] + [outer.difference(inner)
+        for inner, outer in zip(polys[:-1], polys[1:])]
+
+# Find the travel time from a center to every node reached
+# within max_time with a single shortest path run, given
+# the routing matrix of edge times and the start node of
+# each of its edges. Returns the positions of the reached
+# nodes and their times, along with arrays describing every
+# edge leaving a reached node: the positions of its
+# endpoints, the times at which they are reached (inf if
+# never reached within max_time) and the time to traverse
+# it. If times is given, it is used as the center's time to
+# every node instead of running a shortest path search.
+def center_times(matrix, sources, center, max_time, times=None):
+    if times is None:
+        times = shortest_times(matrix, [center], max_time)[0]
+    else:
+        times = np.where(times <= max_time, times, np.inf)
+    nodes = np.flatnonzero(np.isfinite(times))
+
+    leaving = np.isfinite(times[sources])
+    us = sources[leaving]
+    vs = matrix.indices[leaving]
+
+    return (nodes, times[nodes]), \
+        (us, vs, times[us], times[vs], matrix.data[leaving])
+
+# Slice out the part of the network reachable within
+# trip_time from the output of center_times. Returns the
+# positions of the nodes reached, the edges between them as
+# arrays (u, v) and, if partial is set, the edges leaving
+# the reached nodes that are cut at trip_time, as arrays
+# (u, v, fraction of the edge travelled).
+def iso_subgraph(times, edges, trip_time, partial=True):
+    nodes, node_times = times
+    us, vs, u_times, v_times, edge_times = edges
+
+    leaves = u_times <= trip_time
+    inside = leaves & (v_times <= trip_time)
+    # A node reached exactly at trip_time starts no segment,
+    # as in band_deltas.
+    cut = leaves & ~inside & (u_times < trip_time) & (edge_times > 0)
+    if not partial:
+        cut[:] = False
+
+    fractions = np.minimum(
+        (trip_time - u_times[cut]) / edge_times[cut], 1)
+
+    return (nodes[node_times <= trip_time], (us[inside], vs[inside]),
+        (us[cut], vs[cut], fractions))
+
+# Split the part of the network reachable within the longest
+# trip time from the output of center_times by the band in
+# which it first appears, so that each node and segment is
+# only buffered once. Edges are split into pieces at the
+# point reached by each trip time. Returns a list ordered
+# from the smallest trip time to the largest of the
+# positions of the nodes first reached in that band and of
+# the edge pieces first covered, as arrays (u, v, start
+# fraction, end fraction).
+def band_deltas(times, edges, trip_times, partial=True):
+    nodes, node_times = times
+    us, vs, u_times, v_times, edge_times = edges
+    bands = np.sort(trip_times)
+
+    # Smallest band whose trip time reaches each node.
+    node_bands = np.searchsorted(bands, node_times, side='left')
+
+    # Fraction of each edge covered within each band, or -1
+    # if its start has not been reached yet.
+    limits = bands[None, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        travelled = (limits - u_times[:, None]) / edge_times[:, None]
+    whole = v_times[:, None] <= limits
+    if partial:
+        covered = np.where(whole, 1, np.clip(travelled, 0, 1))
+    else:
+        covered = np.where(whole, 1, 0)
+    covered = np.where(u_times[:, None] <= limits, covered, -1)
+
+    deltas = []
+    before = np.zeros(len(us))
+    for b in range(0, len(bands)):
+        grew = covered[:, b] > before
+        deltas.append((nodes[node_bands == b], us[grew], vs[grew],
+            before[grew], covered[grew, b]))
+        before = np.maximum(before, covered[:, b])
+
+    return deltas
+
+# Create the polygons of the isochrone to plot from a
+# graphstore.StreetGraph, its routing matrix of edge times
+# and the positions of the centers. Returns array of arrays
+# of polygons, with one array corresponding to each
+# center. Travel times are computed once per center and
+# sliced for each trip time, or taken from
+# center_distances(center) if given, such as a cache of
+# earlier shortest path runs. If incremental is set, each
+# band is built from the previous one by adding only the
+# geometry first reached within it. If rings is set, each
+# polygon only covers the area not covered by the band
+# below it.
+@instrument.timed('polygons')
+def make_iso_polys(sg, matrix, centers, trip_times, partial=True, 
+        incremental=True, rings=False, center_distances=None):
+    # Define the width of the polygons around
+    #  edges and nodes.
+    edge_buff = 40
+    node_buff = 25
+
+    # Get coordinates and edges of every node by position.
+    xy = node_coords(sg)
+    sources = edge_sources(matrix)
+
+    # Init array to store polygons.
+    isochrone_polys = [[None]] * len(centers)
+    
+    # For each center, create the corresponding 
+    # polygon for the specified travel time.
+    for i in range(0, len(centers)):
+        known = None if center_distances is None else \
+            center_distances(centers[i])
+        times, edges = center_times(matrix, sources, centers[i], 
+            max(trip_times), known)
+
+        if incremental:
+            # Buffer each node and edge piece once in the band
+            # it is first reached and union the bands upward.
+            deltas = []
+            for nodes, u, v, f_start, f_end in band_deltas(
+                    times, edges, trip_times, partial):
+                deltas.append((xy[nodes],
+                    cut_segments(xy[u], xy[v], f_start),
+                    cut_segments(xy[u], xy[v], f_end)))
+            polys = nested_polygons(deltas, node_buff, edge_buff)
+
+        else:
+            polys = []
+            for trip_time in sorted(trip_times):
+
+                # Get the part of the network within the trip
+                # time.
+                nodes, (u, v), (cut_u, cut_v, fractions) = \
+                    iso_subgraph(times, edges, trip_time, partial)
+
+                # Get the segments the isochrone encapsulates,
+                # including the travelled part of edges cut by
+                # the trip time.
+                starts = np.concatenate((xy[u], xy[cut_u]))
+                ends = np.concatenate((xy[v], 
+                    cut_segments(xy[cut_u], xy[cut_v], fractions)))
+
+                # Construct the polygon that represents the 
+                # isochrone, filling in surrounded areas so 
+                # shapes will appear solid.
+                polys.append(iso_polygon(xy[nodes], 
+                    starts, ends, node_buff, edge_buff))
+
+        if rings:
+            polys = ring_polygons(polys)
+
+        # Order polygons from the longest trip time down.
+        isochrone_polys[i] = polys[::-1]
+            
+    return isochrone_polys
+
+def attach_graph(sg, matrix):
+    global worker_graph, worker_matrix
+    worker_graph, worker_matrix = sg, matrix
+
+# Build the polygons of one center in a worker.
+def center_polys(args):
+    center, trip_times, options = args
+    return make_iso_polys(worker_graph, worker_matrix, [center],
+        trip_times, **options)[0]
+
+# Build the polygons of each center in parallel across a
+# pool of processes, which receive the graph and routing
+# matrix once when they start. Takes the same options as
+# make_iso_polys and returns the same result.
+def parallel_iso_polys(sg, matrix, centers, trip_times, processes=None,
+        **options):
+    processes = min(processes or mp.cpu_count(), max(len(centers), 1))
+    tasks = [(center, trip_times, options) for center in centers]
+
+    with mp.Pool(processes, initializer=attach_graph,
+            initargs=(sg, matrix)) as pool:
+        return pool.map(center_polys, tasks, chunksize=1)
+
+# Convert a geometry in a graph's projected crs to latitude
+# and longitude.
+def to_latlon(geom, crs):
+    import pyproj
+
+    transformer = pyproj.Transformer.from_crs(crs, 'EPSG:4326',
+        always_xy=True)
+    return shapely.transform(geom, lambda xy: np.column_stack(
+        transformer.transform(xy[:, 0], xy[:, 1])))
+
+# Convert the polygons from make_iso_polys in a graph's
+# projected crs to a list of GeoJSON features in latitude
+# and longitude, one per center and trip time. Each feature
+# has its trip time and the entries of properties[i] for
+# its center i as properties.
+def iso_features(crs, isochrone_polys, trip_times, properties=None):
+    features = []
+    for i, polys in enumerate(isochrone_polys):
+        for trip_time, poly in zip(sorted(trip_times)[::-1], polys):
+            props = dict(properties[i]) if properties else {}
+            props['trip_time'] = trip_time
+            features.append({'type': 'Feature',
+                'geometry': mapping(to_latlon(poly, crs)),
+                'properties': props})
+
+    return features
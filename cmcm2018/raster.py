@@ -0,0 +1,154 @@
+################### CMCM 2018 ###################
+# Rasterize travel times from the nodes of a street
+# network onto a regular grid and derive isochrones
+# from it. Each cell takes the time of its nearest
+# node (or an inverse distance weighted average of
+# its nearest nodes), so one gather per center gives
+# a travel time surface from which every band is
+# contoured, and the surfaces can be exported as a
+# memory-mapped array for heatmaps.
+
+import os
+import json
+from collections import namedtuple
+import numpy as np
+from scipy.spatial import cKDTree
+
+from routing import shortest_times
+
+# A grid over a projected street network, with cell centers
+# at x (num columns,) and y (num rows,). Each cell takes the
+# time of nodes[r, c, :] weighted by weights[r, c, :], where
+# weights are zero for nodes more than the grid's max
+# distance away.
+Raster = namedtuple('Raster', ['x', 'y', 'nodes', 'weights', 'crs'])
+
+################ Helper Functions ###############
+# Lay a grid of cell_size meter cells over the extent of a
+# graphstore.StreetGraph and find the nodes each cell takes
+# its time from. With the 'nearest' method a cell takes the
+# time of its nearest node; with 'idw' it takes the average
+# of its k nearest nodes weighted by inverse squared
+# distance. Cells further than max_distance meters from
+# every node are left empty.
+def make_raster(sg, cell_size=25, max_distance=75, method='nearest',
+        k=4):
+    if method == 'nearest':
+        k = 1
+    elif method != 'idw':
+        raise ValueError('Unknown method: ' + str(method))
+
+    x = np.arange(np.min(sg.x) - max_distance,
+        np.max(sg.x) + max_distance + cell_size, cell_size)
+    y = np.arange(np.min(sg.y) - max_distance,
+        np.max(sg.y) + max_distance + cell_size, cell_size)
+    cx, cy = np.meshgrid(x, y)
+
+    tree = cKDTree(np.column_stack((sg.x, sg.y)))
+    distances, nodes = tree.query(np.column_stack((cx.ravel(),
+        cy.ravel())), k=k, distance_upper_bound=max_distance)
+    distances = distances.reshape(len(y), len(x), k)
+    nodes = nodes.reshape(len(y), len(x), k)
+
+    # Missing neighbours are given index len(sg.x) by the
+    # tree, so point them at node 0 with zero weight.
+    found = np.isfinite(distances)
+    weights = np.where(found, 1 / np.maximum(distances, 1e-6) ** 2, 0)
+    nodes = np.where(found, nodes, 0)
+
+    return Raster(x, y, nodes.astype(np.intp), weights, sg.crs)
+
+# Rasterize the travel time to every node onto the grid.
+# Returns a (num rows x num columns) array, with inf for
+# cells that are empty or whose nodes are all unreached.
+def rasterize(raster, times):
+    node_times = times[raster.nodes]
+    weights = np.where(np.isfinite(node_times), raster.weights, 0)
+    total = weights.sum(axis=2)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(total > 0, np.sum(weights * np.where(
+            weights > 0, node_times, 0), axis=2) / total, np.inf)
+
+# Contour the area of a travel time grid reached within each
+# trip time, keeping interior holes. Contours touching
+# themselves at a saddle are cleaned up with a zero width
+# buffer. Returns a list of polygons from the smallest trip
+# time to the largest.
+def band_polygons(raster, grid, trip_times):
+    import contourpy
+    from shapely.geometry import Polygon, MultiPolygon
+
+    z = np.ma.masked_invalid(grid)
+    generator = contourpy.contour_generator(raster.x, raster.y, z,
+        fill_type='OuterOffset')
+    lower = min(0, z.min()) - 1 if z.count() else -1
+
+    polys = []
+    for trip_time in sorted(trip_times):
+        parts = []
+        for points, offsets in zip(*generator.filled(lower, trip_time)):
+            rings = [points[start:end]
+                for start, end in zip(offsets[:-1], offsets[1:])]
+            parts.append(Polygon(rings[0], rings[1:]))
+        polys.append(MultiPolygon(parts).buffer(0))
+
+    return polys
+
+# Create the polygons of the isochrone around each center
+# from a raster of its travel times, in the same order as
+# polygons.make_iso_polys: one list per center, from the
+# longest trip time down. Times from each center are taken
+# from center_distances(center) if given, or else found up
+# to the longest trip time. If grid_file is given, the grid
+# of every center is also saved to it as a memory-mapped
+# (num centers x num rows x num columns) float32 array.
+def raster_iso_polys(sg, matrix, centers, trip_times, raster=None,
+        rings=False, center_distances=None, grid_file=None):
+    from polygons import ring_polygons
+
+    if raster is None:
+        raster = make_raster(sg)
+
+    grids = None
+    if grid_file is not None:
+        grids = open_grids(grid_file, raster, len(centers))
+
+    isochrone_polys = []
+    for i, center in enumerate(centers):
+        if center_distances is not None:
+            times = center_distances(center)
+        else:
+            times = shortest_times(matrix, [center], max(trip_times))[0]
+
+        grid = rasterize(raster, times)
+        if grids is not None:
+            grids[i] = grid
+
+        polys = band_polygons(raster, grid, trip_times)
+        if rings:
+            polys = ring_polygons(polys)
+        isochrone_polys.append(polys[::-1])
+
+    if grids is not None:
+        grids.flush()
+    return isochrone_polys
+
+# Create a memory-mapped .npy file holding a float32 grid of
+# the raster for each of num_grids centers, along with a
+# .json file beside it giving the cell centers and crs.
+def open_grids(path, raster, num_grids):
+    with open(os.path.splitext(path)[0] + '.json', 'w') as f:
+        json.dump({'x': raster.x.tolist(), 'y': raster.y.tolist(),
+            'crs': str(raster.crs)}, f)
+
+    return np.lib.format.open_memmap(path, mode='w+', dtype=np.float32,
+        shape=(num_grids, len(raster.y), len(raster.x)))
+
+# Load the grids saved by raster_iso_polys as a read-only
+# memory map, along with the cell centers and crs.
+def load_grids(path):
+    with open(os.path.splitext(path)[0] + '.json') as f:
+        meta = json.load(f)
+    return np.load(path, mmap_mode='r'), np.array(meta['x']), \
+        np.array(meta['y']), meta['crs']
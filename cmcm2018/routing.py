@@ -0,0 +1,69 @@
+################### CMCM 2018 ###################
+# Shortest path queries over a street network held
+# as a scipy sparse CSR matrix, built once from the
+# arrays of a graphstore.StreetGraph. Nodes are
+# referred to by their position in the graph and
+# results are dense arrays of travel times.
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import dijkstra
+
+import instrument
+
+################ Helper Functions ###############
+# Build the CSR matrix of the time in minutes to traverse
+# each edge of a StreetGraph, or of its length in meters if
+# meters_per_minute is not given. Zero weight edges are kept
+# as explicit entries, which csgraph treats as edges.
+@instrument.timed('time_weighting')
+def graph_matrix(sg, meters_per_minute=None):
+    n = len(sg.indptr) - 1
+    weights = np.asarray(sg.length, dtype=float)
+    if meters_per_minute is not None:
+        weights = weights / meters_per_minute
+
+    return sp.csr_matrix((weights, np.asarray(sg.indices),
+        np.asarray(sg.indptr)), shape=(n, n))
+
+# Get the position of the start node of every edge of a CSR
+# matrix, in the order of its entries.
+def edge_sources(matrix):
+    return np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+
+# Count a Dijkstra pass of the given number of sources and
+# the nodes it settled, the finite entries of its times.
+def count_dijkstra(times, num_sources):
+    if instrument.enabled:
+        instrument.count('dijkstra_runs', num_sources)
+        instrument.count('nodes_settled', int(np.isfinite(times).sum()))
+
+# Find the shortest time from each source to every node,
+# stopping at limit. Returns a (num sources x num nodes)
+# array, with inf for nodes not reached within limit.
+def shortest_times(matrix, sources, limit=np.inf):
+    sources = np.asarray(sources, dtype=np.intp)
+    times = dijkstra(matrix, indices=sources, limit=limit)
+    count_dijkstra(times, len(sources))
+    return times
+
+# Find the shortest time from the nearest of the sources to
+# every node, stopping at limit, with one multi-source pass.
+# Returns an array with inf for nodes not reached within
+# limit.
+def nearest_times(matrix, sources, limit=np.inf):
+    times = dijkstra(matrix, indices=np.asarray(sources, dtype=np.intp),
+        limit=limit, min_only=True)
+    count_dijkstra(times, 1)
+    return times
+
+# Find the shortest time from each source to every node in
+# batches of batch_size sources, stopping at limit, so only
+# one batch of dense times is held at once. Yields the index
+# in sources of the first source of each batch along with
+# its (batch size x num nodes) array of times.
+def batched_times(matrix, sources, limit=np.inf, batch_size=64):
+    sources = np.asarray(sources, dtype=np.intp)
+    for start in range(0, len(sources), batch_size):
+        batch = sources[start:start + batch_size]
+        yield start, shortest_times(matrix, batch, limit)
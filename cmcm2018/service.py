@@ -0,0 +1,256 @@
+################### CMCM 2018 ###################
+# Answer average time, coverage combination and
+# isochrone queries over HTTP from a street network
+# loaded once. Shortest distances from each center
+# are kept in an LRU cache, in meters so they serve
+# every travel speed, and repeated centers are free.
+#   python service.py --port 8018
+#   python service.py --socket /tmp/cmcm.sock
+# Queries are JSON objects POSTed to /average,
+# /coverage or /isochrone, for example
+#   {"centers": [[42.45444, -76.51536]], "speed": 10,
+#    "trip_times": [3, 6, 10]}
+# GET /status reports the graph and cache.
+
+import os
+import json
+import argparse
+import functools
+import traceback
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+from graphstore import load_graph, graph_path
+from snapping import load_index, snap_points
+from routing import graph_matrix, shortest_times
+from traveltimes import meters_per_minute, summarize_times
+from coverage import pack_coverage, top_combinations
+from solvers import SOLVERS
+from polygons import make_iso_polys, iso_features
+
+# Solvers available to coverage queries. The 'parallel'
+# solver is left out since it starts worker processes.
+QUERY_SOLVERS = ['brute', 'bnb', 'greedy', 'ilp']
+
+################ Helper Functions ###############
+# Get a required field of a query, raising a ValueError if
+# it is missing.
+def field(query, name):
+    if name not in query:
+        raise ValueError('Missing field: ' + name)
+    return query[name]
+
+
+# A street network held in memory along with its KD-tree,
+# routing matrix of edge lengths and a cache of the
+# shortest distance from recently queried centers.
+class QueryService:
+    def __init__(self, sg, tree, cache_size=256):
+        self.sg = sg
+        self.tree = tree
+        self.matrix = graph_matrix(sg)
+        self.distances = functools.lru_cache(maxsize=cache_size)(
+            self.center_distances)
+
+    # Find the shortest distance in meters from a center
+    # position to every node. Results are shared between
+    # queries through the cache, so they are read-only.
+    def center_distances(self, center):
+        distances = shortest_times(self.matrix, [center])[0]
+        distances.flags.writeable = False
+        return distances
+
+    # Snap the centers of a query to node positions. Returns
+    # the positions along with a description of each center.
+    def snap(self, centers):
+        nodes, distances, flagged = snap_points(self.tree,
+            np.asarray(centers, dtype=float).reshape(-1, 2))
+        snapped = [{'location': list(center),
+            'node': int(self.sg.node_ids[node]),
+            'distance': float(distance), 'flagged': bool(flag)}
+            for center, node, distance, flag in zip(centers, nodes,
+                distances, flagged)]
+        return nodes.tolist(), snapped
+
+    # Average, percentiles and histogram of the time from the
+    # nearest center to every node.
+    def average(self, query):
+        nodes, snapped = self.snap(field(query, 'centers'))
+        rate = meters_per_minute(query.get('speed', 10))
+        trip_times = sorted(query.get('trip_times',
+            [3, 4, 5, 6, 7, 8, 9, 10]))
+        percentiles = query.get('percentiles', [50, 90, 95])
+
+        times = np.minimum.reduce([self.distances(node)
+            for node in nodes]) / rate
+        average, histogram, pcts, unreached = summarize_times(
+            times, trip_times, percentiles)
+
+        return {'centers': snapped, 'average': float(average),
+            'percentiles': dict(zip(map(str, percentiles),
+                pcts.tolist())),
+            'histogram': histogram.tolist(),
+            'unreachable': int(unreached)}
+
+    # Best combinations of num_centers of the centers by the
+    # fraction of nodes reached within trip_time.
+    def coverage(self, query):
+        nodes, snapped = self.snap(field(query, 'centers'))
+        num_centers = field(query, 'num_centers')
+        radius = query.get('trip_time', 6) * \
+            meters_per_minute(query.get('speed', 10))
+        solver = query.get('solver', 'brute')
+        if solver not in QUERY_SOLVERS:
+            raise ValueError('Unknown solver: ' + str(solver))
+        if not 0 < num_centers <= len(nodes):
+            raise ValueError('num_centers must be between 1 and ' +
+                str(len(nodes)))
+        top = query.get('top', 5)
+        if top < 1:
+            raise ValueError('top must be at least 1')
+
+        bits = pack_coverage(np.array([self.distances(node) <= radius
+            for node in nodes]))
+        if solver == 'brute':
+            best = top_combinations(bits, num_centers, top=top)
+        else:
+            combo, size = SOLVERS[solver](bits, num_centers)
+            best = [(size, combo)]
+
+        num_nodes = len(self.sg.node_ids)
+        return {'centers': snapped, 'combinations': [
+            {'centers': [int(i) for i in combo],
+            'coverage': int(size) / num_nodes}
+            for size, combo in best]}
+
+    # Isochrone polygons around each center as a GeoJSON
+    # feature collection in latitude and longitude, with one
+    # feature per center and trip time.
+    def isochrone(self, query):
+        nodes, snapped = self.snap(field(query, 'centers'))
+        rate = meters_per_minute(query.get('speed', 10))
+        trip_times = sorted(query.get('trip_times',
+            [3, 4, 5, 6, 7, 8, 9, 10]))
+
+        # The matrix is in meters, so trip times are scaled to
+        # distances.
+        polys = make_iso_polys(self.sg, self.matrix, nodes,
+            [t * rate for t in trip_times],
+            partial=query.get('partial', True),
+            rings=query.get('rings', False),
+            center_distances=self.distances)
+
+        return {'type': 'FeatureCollection', 'features': iso_features(
+            self.sg.crs, polys, trip_times, [{'center': c['location'],
+            'node': c['node']} for c in snapped])}
+
+    # Describe the graph and the state of the cache.
+    def status(self):
+        info = self.distances.cache_info()
+        return {'nodes': len(self.sg.node_ids),
+            'edges': len(self.sg.indices), 'crs': str(self.sg.crs),
+            'cache': {'hits': info.hits, 'misses': info.misses,
+                'size': info.currsize, 'max_size': info.maxsize}}
+
+
+# Handle queries, each in its own thread, against the
+# QueryService of the server.
+class QueryHandler(BaseHTTPRequestHandler):
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self.send_json(200, self.server.service.status())
+        else:
+            self.send_json(404, {'error': 'Unknown path: ' + self.path})
+
+    def do_POST(self):
+        service = self.server.service
+        queries = {'/average': service.average,
+            '/coverage': service.coverage,
+            '/isochrone': service.isochrone}
+        if self.path not in queries:
+            self.send_json(404, {'error': 'Unknown path: ' + self.path})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            query = json.loads(self.rfile.read(length) or b'{}')
+            if not isinstance(query, dict):
+                raise ValueError('Query must be a JSON object')
+            self.send_json(200, queries[self.path](query))
+        except (ValueError, TypeError) as error:
+            self.send_json(400, {'error': str(error)})
+        except Exception as error:
+            # Any other failure is the server's, but the client
+            # still gets a response.
+            self.log_error('%s', traceback.format_exc())
+            self.send_json(500, {'error': type(error).__name__ + ': ' +
+                str(error)})
+
+    # Clients of a Unix socket have no address.
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+
+class ThreadingUnixServer(socketserver.ThreadingMixIn,
+        socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+# Serve queries against a QueryService on localhost at the
+# given port, or on a Unix socket if socket_path is given.
+def make_server(service, host='127.0.0.1', port=8018, socket_path=None):
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixServer(socket_path, QueryHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), QueryHandler)
+
+    server.service = service
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve coverage and isochrone queries from a '
+        'street network loaded once.')
+    parser.add_argument('--place', default='Ithaca, NY, USA')
+    parser.add_argument('--network-type', default='drive')
+    parser.add_argument('--cache-dir', default='graph_cache')
+    parser.add_argument('--cache-size', type=int, default=256,
+        help='number of centers to keep shortest distances for')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8018)
+    parser.add_argument('--socket', help='serve on this Unix socket')
+    args = parser.parse_args()
+
+    sg = load_graph(args.place, args.network_type,
+        cache_dir=args.cache_dir)
+    tree = load_index(sg, graph_path(args.place, args.network_type,
+        cache_dir=args.cache_dir))
+    server = make_server(QueryService(sg, tree, args.cache_size),
+        args.host, args.port, args.socket)
+
+    print('Serving ' + args.place + ' on ' +
+        (args.socket or args.host + ':' + str(args.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
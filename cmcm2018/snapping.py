@@ -0,0 +1,97 @@
+################### CMCM 2018 ###################
+# Snap (lat, lon) locations to the nearest nodes of
+# a street network in bulk with a KD-tree over the
+# nodes' positions on the unit sphere, where the
+# straight-line (chord) distance orders points the
+# same way as the great circle distance.
+
+import os
+import pickle
+import warnings
+import numpy as np
+from scipy.spatial import cKDTree
+
+import instrument
+
+# Earth radius in meters.
+EARTH_RADIUS = 6371009
+
+################ Helper Functions ###############
+# Convert arrays of latitudes and longitudes in degrees to
+# an (n x 3) array of points on the unit sphere.
+def unit_vectors(lat, lon):
+    lat, lon = np.radians(lat), np.radians(lon)
+    return np.column_stack((np.cos(lat) * np.cos(lon),
+        np.cos(lat) * np.sin(lon), np.sin(lat)))
+
+# Build the KD-tree over the nodes of a StreetGraph.
+def build_index(sg):
+    return cKDTree(unit_vectors(sg.lat, sg.lon))
+
+# Load the KD-tree over the nodes of a StreetGraph cached
+# in the graph's store directory, building and saving it
+# on first use. If path is None the tree is only built.
+@instrument.timed('snap_index')
+def load_index(sg, path=None):
+    if path is None:
+        return build_index(sg)
+
+    file = os.path.join(path, 'kdtree.pickle')
+    if os.path.exists(file):
+        with open(file, 'rb') as f:
+            tree = pickle.load(f)
+        if tree.n == len(sg.lat):
+            return tree
+
+    tree = build_index(sg)
+    with open(file, 'wb') as f:
+        pickle.dump(tree, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return tree
+
+# Check that each (lat, lon) point is a valid coordinate.
+def valid_points(points):
+    lat, lon = points[:, 0], points[:, 1]
+    return np.isfinite(lat) & np.isfinite(lon) & \
+        (np.abs(lat) <= 90) & (np.abs(lon) <= 180)
+
+# Find the k nearest nodes to each (lat, lon) point. Returns
+# the node positions and great circle distances in meters,
+# each of shape (num points,) if k is 1 or (num points x k)
+# otherwise. Invalid points have distance inf.
+def nearest_nodes(tree, points, k=1):
+    points = np.atleast_2d(np.asarray(points, dtype=float))
+    valid = valid_points(points)
+
+    chords, nodes = tree.query(unit_vectors(
+        np.where(valid, points[:, 0], 0),
+        np.where(valid, points[:, 1], 0)), k=k)
+    distances = 2 * EARTH_RADIUS * np.arcsin(np.minimum(chords / 2, 1))
+    if k == 1:
+        distances[~valid] = np.inf
+    else:
+        distances[~valid, :] = np.inf
+
+    return nodes, distances
+
+# Snap each (lat, lon) point to its nearest node, flagging
+# points that are not valid coordinates or are more than
+# max_distance meters from every node, such as a location
+# with the sign of its longitude dropped. Flagged points
+# raise a ValueError if strict is set and a warning
+# otherwise. Returns the node positions, the distances in
+# meters and a mask of the flagged points.
+@instrument.timed('snap_points')
+def snap_points(tree, points, max_distance=1000, strict=False):
+    points = np.atleast_2d(np.asarray(points, dtype=float))
+    nodes, distances = nearest_nodes(tree, points)
+    flagged = ~(distances <= max_distance)
+
+    if flagged.any():
+        message = 'Points far from the street network: ' + \
+            ', '.join('{} ({:.0f} m)'.format(tuple(points[i].tolist()),
+            distances[i]) for i in np.flatnonzero(flagged))
+        if strict:
+            raise ValueError(message)
+        warnings.warn(message)
+
+    return nodes, distances, flagged
@@ -0,0 +1,236 @@
+################### CMCM 2018 ###################
+# Solvers for the maximum coverage siting problem.
+# Each solver takes the packed coverage bits from
+# coverage.coverage_bits and the number of centers
+# to place, and returns a tuple of candidate indices
+# along with the number of nodes they cover.
+
+import heapq
+import math
+import time
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+import scipy.sparse as sp
+
+import instrument
+from coverage import (popcount, score_combinations, best_combination, 
+    top_in_range)
+
+# Coverage bits shared with each worker process.
+worker_memory = None
+worker_bits = None
+
+################ Helper Functions ###############
+# Exhaustively score every combination.
+def brute_force(bits, num_centers):
+    return best_combination(bits, num_centers)
+
+# Attach a worker process to the coverage bits placed in
+# shared memory by parallel_top_combinations.
+def attach_bits(name, shape):
+    global worker_memory, worker_bits
+    worker_memory = shared_memory.SharedMemory(name=name)
+    worker_bits = np.ndarray(shape, dtype=np.uint8, 
+        buffer=worker_memory.buf)
+
+# Score one range of combination ranks in a worker.
+def score_range(args):
+    num_centers, start, stop, top, chunk_size = args
+    return stop - start, top_in_range(worker_bits, num_centers, 
+        start, stop, top, chunk_size)
+
+# Exhaustively score every combination across a pool of
+# processes. The combination space is split into
+# num_ranges contiguous ranges of lexicographic ranks which
+# workers unrank independently, reading the coverage bits
+# from shared memory rather than a pickled copy. Per-range
+# results are merged by (coverage, rank), so the answer is
+# identical to coverage.top_combinations. If progress is
+# given, it is called with (done, total, elapsed seconds)
+# as each range completes. Returns a list of (coverage,
+# combo) pairs from best to worst.
+@instrument.timed('combination_scoring')
+def parallel_top_combinations(bits, num_centers, top=10, 
+        processes=None, num_ranges=None, chunk_size=65536, 
+        progress=None):
+    processes = processes or mp.cpu_count()
+    total = math.comb(len(bits), num_centers)
+    num_ranges = min(num_ranges or 4 * processes, max(total, 1))
+    bounds = [total * r // num_ranges for r in range(num_ranges + 1)]
+    tasks = [(num_centers, bounds[r], bounds[r + 1], top, chunk_size)
+        for r in range(num_ranges)]
+
+    memory = shared_memory.SharedMemory(create=True, 
+        size=max(bits.nbytes, 1))
+    try:
+        np.ndarray(bits.shape, dtype=np.uint8, 
+            buffer=memory.buf)[:] = bits
+
+        entries = []
+        done = 0
+        start = time.perf_counter()
+        with mp.Pool(processes, initializer=attach_bits, 
+                initargs=(memory.name, bits.shape)) as pool:
+            for count, heap in pool.imap_unordered(score_range, tasks):
+                entries = heapq.nlargest(top, entries + heap)
+                done += count
+                if progress is not None:
+                    progress(done, total, time.perf_counter() - start)
+    finally:
+        memory.close()
+        memory.unlink()
+
+    return [(size, combo) for size, _, combo in entries]
+
+# Exhaustively score every combination across all cores.
+def parallel_brute_force(bits, num_centers):
+    results = parallel_top_combinations(bits, num_centers, top=1)
+    if not results:
+        return None, -1
+
+    size, combo = results[0]
+    return combo, size
+
+# Greedily add the candidate with the largest marginal
+# coverage. Marginal gains only shrink as more centers are
+# placed, so stale gains are kept in a heap and only the
+# top one is recomputed until it stays on top.
+@instrument.timed('greedy')
+def lazy_greedy(bits, num_centers):
+    words = bits.view(np.uint64)
+    covered = np.zeros(words.shape[1], dtype=np.uint64)
+    heap = [(-int(size), i) for i, size in enumerate(popcount(bits))]
+    heapq.heapify(heap)
+
+    combo = []
+    while heap and len(combo) < num_centers:
+        _, i = heapq.heappop(heap)
+        gain = int(popcount((words[i] & ~covered).view(np.uint8)))
+
+        # Accept the candidate if its fresh gain still beats
+        # every other (stale) upper bound.
+        if not heap or -heap[0][0] <= gain:
+            combo.append(i)
+            covered |= words[i]
+        else:
+            heapq.heappush(heap, (-gain, i))
+
+    return tuple(sorted(combo)), int(popcount(covered.view(np.uint8)))
+
+# Upper bound on the optimal coverage given the coverage
+# found by the greedy solver, which is guaranteed to be
+# within 1 - (1 - 1/k)^k >= 1 - 1/e of the optimum.
+def greedy_bound(coverage, num_centers):
+    return coverage / (1 - (1 - 1 / num_centers) ** num_centers)
+
+# Exactly solve the siting problem by depth-first branch and
+# bound. Candidates are ordered by coverage and each search
+# node picks the next center from those after the last one
+# chosen. Since coverage is submodular, the union so far plus
+# the largest remaining marginal gains bounds every
+# completion, and subtrees whose bound cannot beat the
+# incumbent (seeded with the greedy solution) are pruned.
+# Returns the proven-optimal combination, its coverage and
+# the number of search nodes explored and pruned.
+@instrument.timed('branch_and_bound')
+def branch_and_bound_search(bits, num_centers):
+    words = bits.view(np.uint64)
+    order = np.argsort(-popcount(bits), kind='stable')
+    best_combo, best_size = lazy_greedy(bits, num_centers)
+    explored, pruned = 0, 0
+
+    def search(start, chosen, covered, size):
+        nonlocal best_combo, best_size, explored, pruned
+        explored += 1
+
+        slots = num_centers - len(chosen)
+        if slots == 0:
+            if size > best_size:
+                best_combo = tuple(sorted(int(i) for i in chosen))
+                best_size = size
+            return
+
+        rest = order[start:]
+        gains = popcount((words[rest] & ~covered).view(np.uint8))
+
+        for j in range(0, len(rest) - slots + 1):
+            # Bound every combination whose next center is
+            # rest[j] or later. Later suffixes only shrink, so
+            # once this fails the remaining siblings are pruned.
+            suffix = gains[j:]
+            bound = size + np.partition(suffix, 
+                len(suffix) - slots)[-slots:].sum()
+            if bound <= best_size:
+                pruned += 1
+                break
+
+            i = rest[j]
+            search(start + j + 1, chosen + [i], covered | words[i],
+                size + int(gains[j]))
+
+    search(0, [], np.zeros(words.shape[1], dtype=np.uint64), 0)
+    return best_combo, best_size, explored, pruned
+
+# Exactly solve the siting problem by branch and bound.
+def branch_and_bound(bits, num_centers):
+    combo, size, _, _ = branch_and_bound_search(bits, num_centers)
+    return combo, size
+
+# Solve the maximum coverage integer program
+#   max sum_g w_g y_g
+#   s.t. y_g <= sum_{i covers g} x_i, sum_i x_i = k,
+#        x binary, 0 <= y <= 1
+# with the HiGHS MILP solver. Nodes reached by exactly the
+# same candidates are merged into one weighted group g.
+@instrument.timed('integer_program')
+def integer_program(bits, num_centers):
+    from scipy.optimize import milp, LinearConstraint, Bounds
+
+    num_cands = len(bits)
+    cover = np.unpackbits(bits, axis=1).astype(bool)
+
+    # Group nodes by the set of candidates that reach them,
+    # dropping nodes that no candidate reaches.
+    signatures = np.packbits(cover.T, axis=1)
+    signatures, weights = np.unique(signatures, axis=0,
+        return_counts=True)
+    groups = np.unpackbits(signatures, axis=1,
+        count=num_cands).astype(bool)
+    reached = groups.any(axis=1)
+    groups, weights = groups[reached], weights[reached]
+    num_groups = len(groups)
+
+    # Variables are ordered x_1..x_n then y_1..y_m.
+    c = np.concatenate((np.zeros(num_cands), -weights))
+    integrality = np.concatenate((np.ones(num_cands),
+        np.zeros(num_groups)))
+
+    # y_g - sum_{i covers g} x_i <= 0.
+    cover_A = sp.hstack((-sp.csr_matrix(groups, dtype=float),
+        sp.identity(num_groups)))
+    count_A = sp.hstack((sp.csr_matrix(np.ones((1, num_cands))),
+        sp.csr_matrix((1, num_groups))))
+
+    constraints = [
+        LinearConstraint(cover_A, -np.inf, 0),
+        LinearConstraint(count_A, num_centers, num_centers)]
+
+    res = milp(c, constraints=constraints, integrality=integrality,
+        bounds=Bounds(0, 1))
+    if not res.success:
+        raise RuntimeError('MILP solver failed: ' + res.message)
+
+    combo = tuple(int(i) for i in 
+        np.flatnonzero(res.x[:num_cands] > 0.5))
+    size = int(score_combinations(bits, np.array([combo]))[0])
+    return combo, size
+
+# Available solvers by name.
+SOLVERS = {
+    'brute': brute_force,
+    'parallel': parallel_brute_force,
+    'bnb': branch_and_bound,
+    'greedy': lazy_greedy,
+    'ilp': integer_program,
+}
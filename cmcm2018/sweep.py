@@ -0,0 +1,101 @@
+################### CMCM 2018 ###################
+# Sweep the response time statistics over many
+# travel speeds. Travel time is length divided by
+# speed, so shortest paths are the same at every
+# speed up to a scale factor: shortest distances
+# are computed once and rescaled for each speed.
+
+import argparse
+import numpy as np
+import pandas as pd
+
+from graphstore import load_graph, graph_path
+from routing import graph_matrix, nearest_times
+from snapping import load_index, snap_points
+from traveltimes import meters_per_minute
+
+################ Helper Functions ###############
+# Distance in meters that can be travelled within each
+# trip time at each speed. Returns a (num speeds x num
+# trip times) array, which gives the isochrone thresholds
+# to use with a routing matrix of edge lengths.
+def iso_thresholds(speeds, trip_times):
+    rates = meters_per_minute(np.asarray(speeds, dtype=float))
+    return rates[:, None] * np.asarray(trip_times, dtype=float)[None, :]
+
+# Derive the response time statistics at each speed from
+# the shortest distance in meters from the nearest center
+# to every node. Distances are sorted once so every speed
+# is answered with searches rather than another pass over
+# the nodes. Returns a table with one row per speed of the
+# average and percentile response times over reachable
+# nodes, the fraction of nodes reached within
+# coverage_time, and for each trip time the isochrone
+# radius in meters and fraction of nodes reached.
+def sweep_distances(distances, speeds, trip_times, coverage_time=6,
+        percentiles=(50, 90, 95)):
+    speeds = np.asarray(speeds, dtype=float)
+    rates = meters_per_minute(speeds)
+    reached = np.sort(distances[np.isfinite(distances)])
+    num_nodes = len(distances)
+
+    table = pd.DataFrame({'speed': speeds, 'meters_per_minute': rates})
+    table['average'] = reached.mean() / rates
+    for p, value in zip(percentiles, np.percentile(reached, percentiles)):
+        table['p' + str(p)] = value / rates
+
+    table['coverage'] = np.searchsorted(reached, coverage_time * rates,
+        side='right') / num_nodes
+    table['unreachable'] = num_nodes - len(reached)
+
+    radii = iso_thresholds(speeds, trip_times)
+    for j, trip_time in enumerate(trip_times):
+        label = '{:g}min'.format(trip_time)
+        table['radius_' + label] = radii[:, j]
+        table['reached_' + label] = np.searchsorted(reached,
+            radii[:, j], side='right') / num_nodes
+
+    return table
+
+# Sweep the response time statistics over speeds for the
+# given center positions on a graphstore.StreetGraph, with
+# a single multi-source shortest distance pass.
+def speed_sweep(sg, center_nodes, speeds, trip_times, coverage_time=6,
+        percentiles=(50, 90, 95)):
+    distances = nearest_times(graph_matrix(sg), center_nodes)
+    return sweep_distances(distances, speeds, trip_times,
+        coverage_time, percentiles)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Sweep response times over travel speeds.')
+    parser.add_argument('--place', default='Ithaca, NY, USA')
+    parser.add_argument('--network-type', default='drive')
+    parser.add_argument('--center', nargs=2, type=float, action='append',
+        metavar=('LAT', 'LON'), help='center location (repeatable)')
+    parser.add_argument('--speeds', nargs='+', type=float,
+        default=list(range(5, 41, 5)), help='travel speeds in mph')
+    parser.add_argument('--trip-times', nargs='+', type=float,
+        default=[3, 4, 5, 6, 7, 8, 9, 10], help='trip times in minutes')
+    parser.add_argument('--coverage-time', type=float, default=6)
+    parser.add_argument('--cache-dir', default='graph_cache')
+    parser.add_argument('--out', help='write the table to this CSV file')
+    args = parser.parse_args()
+
+    centers = args.center or [(42.45444, -76.51536)]
+    sg = load_graph(args.place, args.network_type,
+        cache_dir=args.cache_dir)
+    tree = load_index(sg, graph_path(args.place, args.network_type,
+        cache_dir=args.cache_dir))
+    center_nodes = snap_points(tree, centers)[0]
+
+    table = speed_sweep(sg, center_nodes, args.speeds, args.trip_times,
+        args.coverage_time)
+    if args.out:
+        table.to_csv(args.out, index=False)
+    print(table.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
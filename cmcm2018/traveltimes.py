@@ -0,0 +1,25 @@
+################### CMCM 2018 ###################
+# Convert travel speeds and summarize arrays of
+# travel times from the routing module.
+
+import numpy as np
+
+################ Helper Functions ###############
+# Miles per hour to meter per minute.
+def meters_per_minute(travel_speed):
+    return (travel_speed * 5280 * 12 * 2.54) / (100 * 60)
+
+# Summarize an array of travel times. Returns the average
+# over reachable nodes, the number of nodes falling in each
+# band (t_{i-1}, t_i] of trip_times (with a final bucket for
+# nodes beyond the last band), the requested percentiles
+# and the number of unreachable nodes. The bands are taken
+# in order of trip time, whatever the order given.
+def summarize_times(times, trip_times, percentiles=(50, 90, 95)):
+    trip_times = np.sort(trip_times)
+    reached = times[np.isfinite(times)]
+    bands = np.searchsorted(trip_times, reached, side='left')
+    histogram = np.bincount(bands, minlength=len(trip_times) + 1)
+    return (reached.mean(), histogram, 
+        np.percentile(reached, percentiles), 
+        len(times) - len(reached))
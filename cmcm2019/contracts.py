@@ -1,15 +1,65 @@
 import numpy as np
 import argparse
+import io
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from collections import deque, Counter
+
+# Read-only base data of the replicates run by each worker process.
+worker_base = None
+worker_memory = None
+worker_options = None
 
 ''' Performs the neighbor joining algorithm on a given set of sequences.
 Arguments:
-    D: map of maps, defining distances between the sequences
+    d: distances between the sequences, either a map of maps
+       (index -> index -> distance), an n x n array (symmetric, 0 on the
+       diagonal) or a condensed float32 or float64 array of the upper
+       triangle, which may be memory-mapped (see condensed_distances).
+       The 'matrix' and 'rapid' engines join on an n x n float64 copy
+       held in memory, 8 n^2 bytes or eight times a float32 condensed
+       input, so a compact or memory-mapped input only saves the memory
+       of the input itself. The 'rapid' engine also keeps an
+       n x (n - 1) int32 matrix of sorted slots, 4 n^2 bytes more, and
+       its scans can take as much again when few rows are pruned
+    engine: 'matrix' to join on a NumPy matrix, 'rapid' to search sorted
+        rows of the matrix for each join (faster for thousands of
+        sequences), or 'dict' for the reference implementation on a map
+        of maps, which d must be
+Returns:
+    edges: edges formed using the neighbor-join algorithm, where
+        internal nodes are numbered n, n+1, ... in the order created.
+        Pairs that tie exactly on the criterion are joined in the order
+        of their labels by the 'matrix' and 'rapid' engines, which give
+        the same edges, while the 'dict' engine's choice depends on
+        rounding. Ties always occur at the last two joins, and can occur
+        at any join for degenerate input such as duplicate or equidistant
+        points, where the 'dict' engine may give a different tree
+    d: map of maps giving the length of every edge in both directions,
+        with one entry for each of the 2n - 2 nodes of the tree
+        (the 'dict' engine returns d itself, grown with every distance)
+'''
+def neighbor_join(d, engine='matrix'):
+    if engine == 'matrix':
+        return matrix_neighbor_join(d)
+    elif engine == 'rapid':
+        return rapid_neighbor_join(d)
+    elif engine == 'dict':
+        return dict_neighbor_join(d)
+    else:
+        raise ValueError('Unknown engine: ' + str(engine))
+
+
+''' Reference neighbor joining on a map of maps, which is modified in place.
+Arguments:
+    d: map of maps, defining distances between the sequences
        (initially n x n, symmetric, 0 on the diagonal)
        (index -> index -> distance)
 Returns:
     edges: edges formed using the neighbor-join algorithm
+    d: the map of maps, grown with the distances to every new node
 '''
-def neighbor_join(d):
+def dict_neighbor_join(d):
     n = len(d)
     L = list(range(n))
     edges = []
@@ -72,33 +122,436 @@ def neighbor_join(d):
     return edges, d
 
 
+''' Copy distances into a float NumPy matrix.
+Arguments:
+    d: map of maps (index -> index -> distance), n x n array, or condensed
+       array as returned by condensed_distances
+Returns:
+    D: n x n float64 array
+'''
+def distance_matrix(d):
+    if isinstance(d, dict):
+        n = len(d)
+        return np.array([[d[i][j] for j in range(n)] for i in range(n)],
+            dtype=np.float64)
+
+    if np.ndim(d) == 1:
+        return square_distances(d)
+
+    return np.array(d, dtype=np.float64)
+
+
+''' Find the number of sequences of a condensed distance array.
+Arguments:
+    size: number of entries in the condensed array
+Returns:
+    n: number of sequences, where size = n (n - 1) / 2
+'''
+def condensed_size(size):
+    n = int(round((1 + np.sqrt(1 + 8 * size)) / 2))
+    if n * (n - 1) // 2 != size:
+        raise ValueError('Condensed distances must have n (n - 1) / 2 '
+            'entries, not ' + str(size))
+    return n
+
+
+''' Expand a condensed distance array into a full matrix. The array is
+read one row at a time, so a memory-mapped input is never loaded whole,
+and the lower triangle is mirrored in blocks of rows. The n x n float64
+matrix returned must still fit in memory: twice the size of a float64
+condensed input and four times that of a float32 one.
+Arguments:
+    c: condensed distances, where the distance between i < j is at
+       c[n i - i (i + 1) / 2 + j - i - 1] (the order of
+       scipy.spatial.distance.pdist)
+    block: number of rows mirrored at once
+Returns:
+    D: n x n float64 array
+'''
+def square_distances(c, block=1024):
+    n = condensed_size(len(c))
+    D = np.zeros((n, n))
+
+    start = 0
+    for i in range(n - 1):
+        D[i, i + 1:] = c[start:start + n - i - 1]
+        start += n - i - 1
+
+    for b in range(0, n, block):
+        e = min(b + block, n)
+        D[b:e, :b] = D[:b, b:e].T
+        D[b:e, b:e] += np.triu(D[b:e, b:e], 1).T
+
+    return D
+
+
+''' Compute the condensed Euclidean distances between points in blocks of
+rows, so that only the output array is ever held in full.
+Arguments:
+    points: n x k array of points
+    dtype: type of the distances, float32 halves the memory of float64
+    path: if given, the distances are written to a memory-mapped .npy
+          file at this path, which np.load(path, mmap_mode='r') reopens
+    block: number of rows computed at once
+Returns:
+    c: condensed distances of length n (n - 1) / 2, in the order used by
+       square_distances
+'''
+def condensed_distances(points, dtype=np.float64, path=None, block=256):
+    points = np.asarray(points, dtype=np.float64)
+    n = len(points)
+    size = n * (n - 1) // 2
+
+    if path is not None:
+        c = np.lib.format.open_memmap(path, mode='w+', dtype=dtype,
+            shape=(size,))
+    else:
+        c = np.empty(size, dtype=dtype)
+
+    start = 0
+    for b in range(0, n, block):
+        diff = points[b:b + block, None, :] - points[None, b:, :]
+        dist = np.sqrt(np.sum(diff ** 2, axis=2))
+        for i in range(b, min(b + block, n)):
+            c[start:start + n - i - 1] = dist[i - b, i - b + 1:]
+            start += n - i - 1
+
+    if path is not None:
+        c.flush()
+    return c
+
+
+''' Find the pair minimizing the neighbor joining criterion among the
+active nodes. Values within a relative tolerance of the minimum are
+treated as ties (the criterion ties exactly between a pair and its
+complement among the last four nodes, and anywhere for duplicate or
+equidistant points), which are broken in the order of the node labels,
+as the reference implementation would without rounding (its list of
+nodes is always sorted). The criterion is computed in blocks of rows,
+once for the minimum of each row and again for the rows that tie with
+the least, so no second m x m matrix is needed.
+Arguments:
+    D: matrix whose leading m x m block holds the active distances
+    r: averaged row sums of the active nodes
+    labels: labels of the active nodes
+    rtol: relative tolerance within which values are tied
+    block: number of rows of the criterion computed at once
+Returns:
+    a, b: positions in D of the pair, with labels[a] < labels[b]
+'''
+def best_pair(D, r, labels, rtol=1e-10, block=256):
+    m = len(r)
+    row_min = np.empty(m)
+    for b in range(0, m, block):
+        q = criterion_rows(D, r, np.arange(b, min(b + block, m)))
+        row_min[b:b + block] = q.min(axis=1)
+
+    q_min = row_min.min()
+    limit = q_min + rtol * max(abs(q_min), 1)
+    tied = np.flatnonzero(row_min <= limit)
+    rows, cols = np.nonzero(criterion_rows(D, r, tied) <= limit)
+    return first_pair(tied[rows], cols, labels)
+
+
+''' Compute given rows of the neighbor joining criterion.
+Arguments:
+    D: matrix whose leading m x m block holds the active distances
+    r: averaged row sums of the active nodes
+    rows: positions of the rows
+Returns:
+    q: len(rows) x m criterion, inf where a row meets its own column
+'''
+def criterion_rows(D, r, rows):
+    m = len(r)
+    q = D[rows, :m] - r[rows, None]
+    q -= r[None, :]
+    q[np.arange(len(rows)), rows] = np.inf
+    return q
+
+
+''' Pick the tied pair whose labels come first, smallest label first.
+Arguments:
+    rows, cols: positions of the tied pairs
+    labels: labels of the nodes at each position
+Returns:
+    a, b: positions of the pair, with labels[a] < labels[b]
+'''
+def first_pair(rows, cols, labels):
+    lo = np.minimum(labels[rows], labels[cols])
+    hi = np.maximum(labels[rows], labels[cols])
+    best = np.lexsort((hi, lo))[0]
+
+    a, b = rows[best], cols[best]
+    if labels[a] > labels[b]:
+        a, b = b, a
+    return a, b
+
+
+''' Neighbor joining on a preallocated n x n matrix. The active nodes are
+kept in the leading m x m block: each new node takes the slot of the first
+node it joins and the last active node is moved into the slot of the
+second, so the matrix shrinks in place and never grows. Row sums over the
+active nodes are updated incrementally rather than recomputed, and the
+criterion is computed in blocks of rows (see best_pair), so the matrix is
+the only n x n array held.
+Arguments:
+    d: map of maps (index -> index -> distance), n x n array, or condensed
+       array as returned by condensed_distances
+Returns:
+    edges: edges formed using the neighbor-join algorithm, which match
+        dict_neighbor_join except where the criterion ties (see
+        neighbor_join)
+    lengths: map of maps giving the length of every edge
+'''
+def matrix_neighbor_join(d):
+    D = distance_matrix(d)
+    n = len(D)
+    if n < 2:
+        raise ValueError('Neighbor joining needs at least 2 sequences')
+
+    labels = np.arange(n)
+    row_sums = D.sum(axis=1)
+    edges = []
+    lengths = {i: {} for i in range(2 * n - 2)}
+
+    k = n
+    for m in range(n, 2, -1):
+        # Find the pair minimizing the criterion over the active nodes.
+        r = row_sums[:m] / (m - 2)
+        i, j = best_pair(D, r, labels[:m])
+        i_label, j_label = int(labels[i]), int(labels[j])
+
+        # Add new node k and add edges.
+        d_ij = float(D[i, j])
+        d_ik = (1 / 2) * (d_ij + float(r[i] - r[j]))
+        d_jk = d_ij - d_ik
+        edges.append((i_label, k))
+        edges.append((j_label, k))
+        lengths[i_label][k] = lengths[k][i_label] = d_ik
+        lengths[j_label][k] = lengths[k][j_label] = d_jk
+
+        # Store k in the slot of i and update the row sums.
+        new_row = (1 / 2) * (D[i, :m] + D[j, :m] - d_ij)
+        row_sums[:m] += new_row - D[i, :m] - D[j, :m]
+        D[i, :m] = new_row
+        D[:m, i] = new_row
+        D[i, i] = 0
+        labels[i] = k
+
+        # Move the last active node into the slot of j.
+        last = m - 1
+        if j != last:
+            D[j, :m] = D[last, :m]
+            D[:m, j] = D[:m, last]
+            D[j, j] = 0
+            labels[j] = labels[last]
+            row_sums[j] = row_sums[last]
+            if i == last:
+                i = j
+        row_sums[i] = D[i, :last].sum()
+
+        k += 1
+
+    # Add termination case.
+    i_label, j_label = sorted((int(labels[0]), int(labels[1])))
+    edges.append((i_label, j_label))
+    lengths[i_label][j_label] = lengths[j_label][i_label] = float(D[0, 1])
+
+    return edges, lengths
+
+
+''' Sort the given rows of the distance matrix over the active slots, so
+that row s of S lists the other active slots from nearest to furthest.
+Rows are sorted in blocks to bound the memory used.
+Arguments:
+    D: distance matrix
+    S: matrix of sorted slots, filled in place
+    length: number of sorted entries in each row, filled in place
+    rows: slots of the rows to sort
+    slots: active slots
+    block: number of rows sorted at once
+'''
+def sort_rows(D, S, length, rows, slots, block=256):
+    for start in range(0, len(rows), block):
+        part = rows[start:start + block]
+        dist = D[np.ix_(part, slots)]
+
+        # Sort each row's own slot last so it can be dropped.
+        own = np.searchsorted(slots, part)
+        dist[np.arange(len(part)), own] = np.inf
+        order = np.argsort(dist, axis=1, kind='stable')[:, :-1]
+
+        S[part, :len(slots) - 1] = slots[order]
+        length[part] = len(slots) - 1
+
+
+''' Find the pair minimizing the neighbor joining criterion by scanning
+each active row of S in order of distance, RapidNJ style. Since r is at
+most u, an entry of row s at distance D[s, t] has criterion at least
+D[s, t] - r[s] - u, and entries are sorted, so a row is scanned in chunks
+of doubling width until that bound passes the best criterion found.
+Entries of S whose slot was freed or taken by a newer node than the row
+are dead and skipped. The distance of a dead entry may have been
+overwritten by the newer node, so the bound is taken from the furthest
+live entry scanned, whose distance is still the one it was sorted by.
+Arguments:
+    D: distance matrix
+    S: matrix of sorted slots
+    length: number of sorted entries in each row
+    epoch: newest label when each row was sorted
+    labels: label of the node in each slot, -1 for free slots
+    slots: active slots
+    r: averaged row sums of each slot
+    rtol: relative tolerance within which values are tied, as in best_pair
+Returns:
+    i, j: slots of the pair, with labels[i] < labels[j]
+'''
+def rapid_pair(D, S, length, epoch, labels, slots, r, rtol=1e-10):
+    u = r[slots].max()
+    rows = slots
+    floor = np.full(len(rows), -np.inf)
+    start = 0
+    width = 8
+    q_best = np.inf
+    found = []
+
+    while len(rows):
+        stop = min(start + width, int(length[rows].max()))
+        cols = S[rows[:, None], np.arange(start, stop)]
+        dist = D[rows[:, None], cols]
+        q = (dist - r[rows][:, None]) - r[cols]
+
+        col_labels = labels[cols]
+        live = ((np.arange(start, stop) < length[rows][:, None]) &
+            (col_labels >= 0) & (col_labels <= epoch[rows][:, None]))
+        a, b = np.nonzero(live)
+        if len(a):
+            found.append((rows[a], cols[a, b], q[a, b]))
+            q_best = min(q_best, q[a, b].min())
+
+        # Keep scanning rows whose remaining entries may still tie.
+        floor = np.maximum(floor, np.where(live, dist, -np.inf).max(axis=1))
+        limit = q_best + rtol * max(abs(q_best), 1)
+        bound = (floor - r[rows]) - u
+        keep = (stop < length[rows]) & (bound <= limit)
+        rows = rows[keep]
+        floor = floor[keep]
+        start = stop
+        width *= 2
+
+    rows, cols, q = (np.concatenate(x) for x in zip(*found))
+    tied = q <= limit
+    return first_pair(rows[tied], cols[tied], labels)
+
+
+''' Neighbor joining with a RapidNJ style search for each join. Every
+active row keeps the other slots sorted by distance, so most pairs are
+pruned without computing their criterion; see rapid_pair. Each new node
+takes the slot of the first node it joins and gets a freshly sorted row,
+while rows of older nodes are only re-sorted once half the nodes they
+were sorted over have been joined. The sorted slots take an n x (n - 1)
+int32 matrix besides the n x n float64 distances.
+Arguments:
+    d: map of maps (index -> index -> distance), n x n array, or condensed
+       array as returned by condensed_distances
+Returns:
+    edges: edges formed using the neighbor-join algorithm, with the
+        same joins as matrix_neighbor_join, as ties are broken alike
+    lengths: map of maps giving the length of every edge
+'''
+def rapid_neighbor_join(d):
+    D = distance_matrix(d)
+    n = len(D)
+    if n < 2:
+        raise ValueError('Neighbor joining needs at least 2 sequences')
+
+    labels = np.arange(n)
+    row_sums = D.sum(axis=1)
+    S = np.empty((n, max(n - 1, 1)), dtype=np.int32)
+    length = np.zeros(n, dtype=np.intp)
+    epoch = np.full(n, n - 1)
+    edges = []
+    lengths = {i: {} for i in range(2 * n - 2)}
+
+    slots = np.arange(n)
+    sort_rows(D, S, length, slots, slots)
+    sorted_over = n
+
+    k = n
+    for m in range(n, 2, -1):
+        r = row_sums / (m - 2)
+        i, j = rapid_pair(D, S, length, epoch, labels, slots, r)
+        i_label, j_label = int(labels[i]), int(labels[j])
+
+        # Add new node k and add edges.
+        d_ij = float(D[i, j])
+        d_ik = (1 / 2) * (d_ij + float(r[i] - r[j]))
+        d_jk = d_ij - d_ik
+        edges.append((i_label, k))
+        edges.append((j_label, k))
+        lengths[i_label][k] = lengths[k][i_label] = d_ik
+        lengths[j_label][k] = lengths[k][j_label] = d_jk
+
+        # Store k in the slot of i, free the slot of j and update
+        # the row sums.
+        new_row = (1 / 2) * (D[i, slots] + D[j, slots] - d_ij)
+        row_sums[slots] += new_row - D[i, slots] - D[j, slots]
+        D[i, slots] = new_row
+        D[slots, i] = new_row
+        D[i, i] = 0
+
+        labels[i] = k
+        labels[j] = -1
+        slots = slots[slots != j]
+        row_sums[i] = D[i, slots].sum()
+
+        # Sort the row of k, or every row once enough are stale.
+        if 2 * (m - 1) <= sorted_over:
+            sort_rows(D, S, length, slots, slots)
+            epoch[slots] = k
+            sorted_over = m - 1
+        else:
+            sort_rows(D, S, length, np.array([i]), slots)
+            epoch[i] = k
+
+        k += 1
+
+    # Add termination case.
+    i_label, j_label = sorted(int(labels[s]) for s in slots)
+    edges.append((i_label, j_label))
+    lengths[i_label][j_label] = lengths[j_label][i_label] = \
+        float(D[slots[0], slots[1]])
+
+    return edges, lengths
+
+
 ''' Helper function for defining a tree data structure.
     First finds the edge to add a root node to and then generates binary tree.
     Root node should be at the midpoint of the longest branch.
+    The edges are indexed by node once and the tree is walked with a
+    stack, so this takes O(n) time however deep the tree is.
 Arguments:
-    n: number of vertices
+    root: root node
     edges: edges in the tree
 Returns:
-    root: root node
     tree_map: map from nodes in the tree -> list of children (leaves have
-              empty lists)
+              empty lists), with children in the order of their edges
 '''
 def assemble_tree(root, edges):
-    children = []
-    new_edges = []
-    for (i,j) in edges:
-        if i == root:
-            children.append(j)
-
-        elif j == root:
-            children.append(i)
-            
-        else:
-            new_edges.append((i,j))
+    neighbours = {root: []}
+    for (i, j) in edges:
+        neighbours.setdefault(i, []).append(j)
+        neighbours.setdefault(j, []).append(i)
+
+    tree_map = {}
+    stack = [(root, None)]
+    while stack:
+        node, parent = stack.pop()
+        children = [m for m in neighbours[node] if m != parent]
+        tree_map[node] = children
 
-    tree_map = {root: children}
-    for child in children:
-        tree_map.update(assemble_tree(child, new_edges))
+        for child in reversed(children):
+            stack.append((child, node))
 
     return tree_map
 
@@ -113,21 +566,75 @@ Returns:
 '''
 def bfs(root, tree_map):
     visited = []
-    queue = [root]
- 
+    seen = {root}
+    queue = deque([root])
+
     while queue:
-        node = queue.pop(0)
-        if node not in visited:
-            
-            visited.append(node)
-            neighbours = tree_map[node]
-            
-            for neighbour in neighbours:
+        node = queue.popleft()
+        visited.append(node)
+
+        for neighbour in tree_map[node]:
+            if neighbour not in seen:
+                seen.add(neighbour)
                 queue.append(neighbour)
 
     return visited
 
 
+''' Writes the Newick tree format for the tree rooted at `root` to a file-like
+object. The tree is walked with a stack rather than recursion and written in
+chunks, so large trees never build one long string.
+
+Arguments:
+    out: file-like object with a write method
+    root: root of the tree (int)
+    tree_map: map from node to list, describing each node's immediate children
+    d: map of maps giving the length of every edge
+    mapping: index to name mapping (dictionary)
+    chunk: number of pieces joined per write
+'''
+def write_newick(out, root, tree_map, d, mapping = None, chunk = 4096):
+    parts = []
+    stack = [(root, None)]
+
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            parts.append(item)
+
+        else:
+            node, parent = item
+            children = tree_map[node]
+
+            # The two children of the root split the edge between them.
+            if parent is None:
+                suffix = ""
+            elif parent == root:
+                (i, j) = tree_map[root]
+                suffix = ":{:.6f}".format(d[i][j] / 2)
+            else:
+                suffix = ":{:.6f}".format(d[parent][node])
+
+            if not children:
+                name = mapping[node] if mapping != None else str(node)
+                parts.append(name + suffix)
+
+            else:
+                parts.append("(")
+                stack.append(")" + suffix)
+                for k in range(len(children) - 1, -1, -1):
+                    stack.append((children[k], node))
+                    if k:
+                        stack.append(",")
+
+        if len(parts) >= chunk:
+            out.write("".join(parts))
+            parts = []
+
+    parts.append(";")
+    out.write("".join(parts))
+
+
 ''' Returns a string of the Newick tree format for the tree rooted at `root`.
 
 Arguments:
@@ -138,44 +645,199 @@ Arguments:
 Returns:
     output: rooted tree in Newick tree format (string)
 '''
-def generate_newick(root, tree_map, d, mapping = None, first = True):
-    if not tree_map[root]:
-        if mapping != None:
-            return mapping[root]
-        else:
-            return str(root)
+def generate_newick(root, tree_map, d, mapping = None):
+    out = io.StringIO()
+    write_newick(out, root, tree_map, d, mapping)
+    return out.getvalue()
 
-    (i, j) = tree_map[root]
 
-    i_length = (d[i][j] / 2) if first else d[root][i]
-    j_length = (d[i][j] / 2) if first else d[root][j]
 
+''' Draw random 64 bit keys for the leaves, which identify a split by the
+XOR of the keys on one side of it.
+Arguments:
+    n: number of leaves
+    seed: seed of the keys, which must match between trees being compared
+Returns:
+    keys: list of n ints
+'''
+def split_keys(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return [int(x) for x in rng.integers(0, 2**63, size=n, dtype=np.int64)]
 
-    output = "({}:{:.6f},{}:{:.6f})".format(
-        generate_newick(i, tree_map, d, mapping, first = False),
-        i_length,
-        generate_newick(j, tree_map, d, mapping, first = False),
-        j_length)
 
-    if first:
-        output += ";"
+''' Hash the splits of an unrooted tree from neighbor_join. Each internal
+edge splits the leaves in two, and is hashed by the XOR of the keys of
+the leaves on either side, taking the smaller of the two so that both
+sides give the same hash. This takes O(n) time.
+Arguments:
+    edges: edges of the tree, with leaves numbered 0 to n - 1
+    keys: key of each leaf from split_keys
+Returns:
+    splits: map from split hash -> edge in edges, for every edge between
+            two internal nodes
+'''
+def tree_splits(edges, keys):
+    n = len(keys)
+    if n < 4:
+        return {}
+
+    # Root the tree at an internal node, so that every other internal
+    # node splits its subtree from the rest.
+    root = 2 * n - 3
+    tree_map = assemble_tree(root, edges)
+    total = 0
+    for key in keys:
+        total ^= key
+
+    hashes = {}
+    for node in reversed(bfs(root, tree_map)):
+        if node < n:
+            hashes[node] = keys[node]
+        else:
+            h = 0
+            for child in tree_map[node]:
+                h ^= hashes[child]
+            hashes[node] = h
 
-    return output
+    splits = {}
+    for (i, j) in edges:
+        if i >= n and j >= n:
+            child = j if j in tree_map[i] else i
+            h = hashes[child]
+            splits[min(h, h ^ total)] = (i, j)
 
+    return splits
 
 
-def main():
-    n = 20
-    points = [0 for i in range(n)]
-    for i in range(n):
-        points[i] = (np.random.randint(100) + 1, np.random.randint(100) + 1)
+''' Draw the distances of one replicate from the base data.
+Arguments:
+    base: n x k array of points for 'resample', or condensed distances
+          for 'perturb'
+    rng: NumPy random generator of the replicate
+    method: 'resample' to draw the k coordinates of the points with
+            replacement, or 'perturb' to scale each distance by lognormal
+            noise
+    scale: standard deviation of the log of the noise for 'perturb'
+Returns:
+    c: condensed float64 distances
+'''
+def replicate_distances(base, rng, method='resample', scale=0.1):
+    if method == 'resample':
+        columns = rng.integers(0, base.shape[1], size=base.shape[1])
+        return condensed_distances(base[:, columns])
+    elif method == 'perturb':
+        return base * np.exp(scale * rng.standard_normal(len(base)))
+    else:
+        raise ValueError('Unknown method: ' + str(method))
+
 
-    d = {i:{} for i in range(n)}
-    for i in range(n):
-        for j in range(n):
-            d[i][j] = np.sqrt((points[i][0] - points[j][0])**2 +(points[i][1] - points[j][1])**2)
+''' Attach a worker process to the base data in shared memory.
+Arguments:
+    name: name of the shared memory block
+    shape, dtype: shape and type of the base array
+    options: method, scale, engine and keys of the replicates
+'''
+def attach_base(name, shape, dtype, options):
+    global worker_base, worker_memory, worker_options
+    worker_memory = shared_memory.SharedMemory(name=name)
+    worker_base = np.ndarray(shape, dtype=dtype, buffer=worker_memory.buf)
+    worker_base.flags.writeable = False
+    worker_options = options
 
-    edges, d = neighbor_join(d)
+
+''' Run one replicate in a worker process, keeping only its splits.
+Arguments:
+    seed: NumPy SeedSequence of the replicate
+Returns:
+    hashes: list of the split hashes of the replicate tree
+'''
+def replicate_splits(seed):
+    method, scale, engine, keys = worker_options
+    c = replicate_distances(worker_base, np.random.default_rng(seed),
+        method, scale)
+    edges, _ = neighbor_join(c, engine)
+    return list(tree_splits(edges, keys))
+
+
+''' Run neighbor joining on many replicates of the base data across a pool
+of processes and count how often each split appears. The base data is
+copied once into shared memory which every worker reads, and each
+replicate tree is reduced to its split hashes as soon as it is built, so
+only the counts are kept.
+Arguments:
+    base: n x k array of points for 'resample', or condensed distances
+          for 'perturb' (see replicate_distances)
+    replicates: number of replicates
+    method: 'resample' or 'perturb'
+    scale: noise of the 'perturb' method
+    engine: engine used by neighbor_join
+    processes: number of worker processes, or None to use every core
+    seed: seed of the replicates and of the split keys
+Returns:
+    counts: Counter from split hash -> number of replicates with it
+'''
+def bootstrap_splits(base, replicates, method='resample', scale=0.1,
+        engine='matrix', processes=None, seed=0):
+    base = np.ascontiguousarray(base)
+    base = base.astype(np.result_type(base.dtype, np.float32), copy=False)
+    n = len(base) if method == 'resample' else condensed_size(len(base))
+    options = (method, scale, engine, split_keys(n, seed))
+    seeds = np.random.SeedSequence(seed).spawn(replicates)
+
+    memory = shared_memory.SharedMemory(create=True, size=max(base.nbytes, 1))
+    try:
+        np.ndarray(base.shape, dtype=base.dtype, buffer=memory.buf)[...] = base
+        counts = Counter()
+        with mp.Pool(processes, initializer=attach_base,
+                initargs=(memory.name, base.shape, base.dtype, options)) as pool:
+            for hashes in pool.imap_unordered(replicate_splits, seeds):
+                counts.update(hashes)
+    finally:
+        memory.close()
+        memory.unlink()
+
+    return counts
+
+
+''' Find the support of each internal edge of a tree, as the fraction of
+replicates from bootstrap_splits that share its split.
+Arguments:
+    edges: edges of the tree from neighbor_join
+    counts: split counts from bootstrap_splits
+    replicates: number of replicates
+    seed: seed given to bootstrap_splits
+Returns:
+    support: map from edge between two internal nodes -> support in [0, 1]
+'''
+def edge_support(edges, counts, replicates, seed=0):
+    n = (len(edges) + 3) // 2
+    splits = tree_splits(edges, split_keys(n, seed))
+    return {edge: counts[h] / replicates for h, edge in splits.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Neighbor join random points.')
+    parser.add_argument('-n', type=int, default=20, help='number of points')
+    parser.add_argument('--replicates', type=int, default=0,
+        help='number of perturbed replicates to find edge support from')
+    parser.add_argument('--processes', type=int, default=None,
+        help='number of processes for the replicates (default: every core)')
+    args = parser.parse_args()
+
+    n = args.n
+    points = np.random.randint(100, size=(n, 2)) + 1
+    c = condensed_distances(points)
+
+    edges, d = neighbor_join(c)
+
+    # Find the support of each internal edge over replicates.
+    if args.replicates:
+        counts = bootstrap_splits(c, args.replicates, method='perturb',
+            processes=args.processes)
+        support = edge_support(edges, counts, args.replicates)
+        for edge in sorted(support):
+            print('{}: {:.2f}'.format(edge, support[edge]))
 
     # Find maximum length edge.
     d_max = 0
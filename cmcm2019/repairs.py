@@ -1,10 +1,6 @@
-from mpl_toolkits.mplot3d import Axes3D
+import argparse
 import numpy as np
 import cvxpy as cp
-import matplotlib.pyplot as plt
-import matplotlib.colors as colors
-from matplotlib.lines import Line2D
-import scipy.optimize as opt
 
 
 ''' Compute the constraints in terms of a linear system.
@@ -183,7 +179,61 @@ def compute_cost(raise_cost, cut_cost, replace_cost, deltas):
     return cost
 
 
+''' Plot each slab of a sidewalk before and after repairs in 3D.
+Matplotlib is only imported here, so headless runs never load it.
+Arguments:
+    slab_width: Width in inches of a slab.
+    slab_length: Length in inches of a slab.
+    H: Map of slabs to height in inches of each corner.
+    deltas: Array of the change in height of each corner of each slab.
+'''
+def plot_repairs(slab_width, slab_length, H, deltas):
+    from mpl_toolkits.mplot3d import Axes3D
+    import matplotlib.pyplot as plt
+    import matplotlib.colors as colors
+    from matplotlib.lines import Line2D
+
+    n_slabs = len(H)
+    fig = plt.figure()
+    ax = Axes3D(fig)
+    ax.set_xlim([-slab_width, 3*slab_width])
+    ax.set_ylim([0, (n_slabs+1)*slab_length])
+    ax.set_zlim([0, 8])
+    for i in range(n_slabs):
+        a, b, c, d = H[i]
+        da, db, dc, dd = deltas[i]
+
+        x_start = i*slab_width
+        y_start = i*slab_length
+
+        cmap_before = [1, 0, 0, 0.75]
+        cmap_after = [0, 0, 1, 0.75]
+        ax.plot_trisurf(
+            [0, slab_width, 0, slab_width], 
+            [y_start, y_start, y_start + slab_length, y_start + slab_length], 
+            [a, b, c, d], 
+            cmap=colors.ListedColormap(cmap_before))
+
+        ax.plot_trisurf(
+            [0 + slab_width, slab_width + slab_width, 0 + slab_width, slab_width + slab_width], 
+            [y_start, y_start, y_start + slab_length, y_start + slab_length], 
+            [a + da, b + db, c + dc, d + dd], 
+            cmap=colors.ListedColormap(cmap_after))
+
+    custom_lines = [Line2D([0], [0], color=cmap_before, lw=5),
+                    Line2D([0], [0], color=cmap_after, lw=5)]
+    ax.legend(custom_lines, ['Original sidewalk', 'After repairs'])
+    #ax.view_init(elev=0, azim=0)
+    plt.show()
+
+
 def main():
+    parser = argparse.ArgumentParser(
+        description='Find the optimal repairs of a random sidewalk.')
+    parser.add_argument('--headless', action='store_true',
+        help='print the repairs without plotting them')
+    args = parser.parse_args()
+
     # Height and width in inches.
     slab_width = 4
     slab_length = 5
@@ -225,38 +275,8 @@ def main():
     print("Changes: ")    
     print(deltas)
 
-    # Plot results.
-    fig = plt.figure()
-    ax = Axes3D(fig)
-    ax.set_xlim([-slab_width, 3*slab_width])
-    ax.set_ylim([0, (n_slabs+1)*slab_length])
-    ax.set_zlim([0, 8])
-    for i in range(n_slabs):
-        a, b, c, d = H[i]
-        da, db, dc, dd = deltas[i]
-
-        x_start = i*slab_width
-        y_start = i*slab_length
-
-        cmap_before = [1, 0, 0, 0.75]
-        cmap_after = [0, 0, 1, 0.75]
-        ax.plot_trisurf(
-            [0, slab_width, 0, slab_width], 
-            [y_start, y_start, y_start + slab_length, y_start + slab_length], 
-            [a, b, c, d], 
-            cmap=colors.ListedColormap(cmap_before))
-
-        ax.plot_trisurf(
-            [0 + slab_width, slab_width + slab_width, 0 + slab_width, slab_width + slab_width], 
-            [y_start, y_start, y_start + slab_length, y_start + slab_length], 
-            [a + da, b + db, c + dc, d + dd], 
-            cmap=colors.ListedColormap(cmap_after))
-
-    custom_lines = [Line2D([0], [0], color=cmap_before, lw=5),
-                    Line2D([0], [0], color=cmap_after, lw=5)]
-    ax.legend(custom_lines, ['Original sidewalk', 'After repairs'])
-    #ax.view_init(elev=0, azim=0)
-    plt.show()
+    if not args.headless:
+        plot_repairs(slab_width, slab_length, H, deltas)
 
 if __name__ == "__main__":
     main()
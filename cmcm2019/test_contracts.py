@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from contracts import (condensed_distances, matrix_neighbor_join,
+    rapid_neighbor_join)
+
+# Seeds of random_input on which the pruning bound of rapid_pair is
+# easily overestimated, checked along with the first 100 seeds.
+HARD_SEEDS = [448, 744, 942, 1132, 1162, 1241, 1472]
+
+
+''' Draw a random input that is far from tree-like, where the pruning bound
+of rapid_pair is tightest: uniform planar points for odd seeds and a random
+symmetric matrix for even ones.
+Arguments:
+    seed: seed of the input
+Returns:
+    c: condensed distances of 5 to 199 sequences
+'''
+def random_input(seed):
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(5, 200))
+    if seed % 2:
+        return condensed_distances(rng.random((n, 2)))
+    return rng.random(n * (n - 1) // 2)
+
+
+@pytest.mark.parametrize('seed', HARD_SEEDS + list(range(100)))
+def test_rapid_matches_matrix(seed):
+    c = random_input(seed)
+    assert rapid_neighbor_join(c)[0] == matrix_neighbor_join(c)[0]